@@ -0,0 +1,113 @@
+import cv2
+import numpy as np
+
+class BeautyClassifierInterface:
+	"""
+	A wrapper around the CNN beauty face detection model with a selectable inference backend.
+
+	Attributes
+		backend: str
+			"keras" to run the SavedModel with TensorFlow,
+			"tflite" to run a model converted by convert_model.py.
+
+		input_size: int
+			Width and height of the network input.
+
+		model:
+			The keras model, or None for the tflite backend.
+
+		interpreter:
+			The tflite interpreter, or None for the keras backend.
+	"""
+	def __init__(self, model_source = "./CNN_beauty_face_detection_model", backend = "keras",
+		intra_op_threads = 0, inter_op_threads = 0, input_size = 128):
+		"""
+		Load the model with the given backend.
+
+		Parameter:
+			model_source: str
+				Path to the SavedModel directory for "keras", or to the .tflite file for "tflite".
+
+			backend: str
+
+			intra_op_threads: int
+				Number of threads used inside an operation. 0 lets the runtime decide.
+
+			inter_op_threads: int
+				Number of operations run in parallel. 0 lets the runtime decide.
+				Only used by the keras backend, the tflite interpreter runs operations sequentially.
+
+			input_size: int
+		"""
+		self.backend     = backend
+		self.input_size  = input_size
+		self.model       = None
+		self.interpreter = None
+
+		if backend == "keras":
+			import tensorflow as tf
+			# Thread settings must be applied before TensorFlow creates its thread pools
+			tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+			tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+			self.model = tf.keras.models.load_model(model_source)
+		elif backend == "tflite":
+			try:
+				# The standalone runtime avoids the long TensorFlow import
+				from tflite_runtime.interpreter import Interpreter
+			except ImportError:
+				import tensorflow as tf
+				Interpreter = tf.lite.Interpreter
+			self.interpreter = Interpreter(model_path = model_source, num_threads = intra_op_threads if intra_op_threads > 0 else None)
+			self.interpreter.allocate_tensors()
+			self.input_detail  = self.interpreter.get_input_details()[0]
+			self.output_detail = self.interpreter.get_output_details()[0]
+			self.batch_size    = None
+		else:
+			raise ValueError(f'''unknown backend "{backend}"''')
+
+	def preprocess(self, image):
+		"""
+		Return the image resized to the network input size.
+
+		Parameter:
+			image: numpy array
+				Color image as read by cv2.imread.
+		"""
+		return cv2.resize(image, (self.input_size, self.input_size), interpolation = cv2.INTER_AREA)
+
+	def predict(self, batch):
+		"""
+		Return a 1D numpy array of probabilities.
+
+		Parameter:
+			batch: numpy array
+				uint8 array of shape (N, input_size, input_size, 3) of preprocessed images.
+		"""
+		if len(batch) == 0:
+			return np.zeros(0, np.float32)
+
+		batch = np.asarray(batch, np.float32) * (1. / 255)
+
+		if self.backend == "keras":
+			return self.model.predict(batch, verbose = 0).reshape(-1)
+
+		if self.batch_size != len(batch):
+			self.interpreter.resize_tensor_input(self.input_detail["index"], batch.shape)
+			self.interpreter.allocate_tensors()
+			self.batch_size = len(batch)
+
+		# Quantize the input and dequantize the output of int8 models
+		scale, zero_point = self.input_detail["quantization"]
+		if self.input_detail["dtype"] != np.float32:
+			limits = np.iinfo(self.input_detail["dtype"])
+			batch = np.clip(np.round(batch / scale + zero_point), limits.min, limits.max).astype(self.input_detail["dtype"])
+
+		self.interpreter.set_tensor(self.input_detail["index"], batch)
+		self.interpreter.invoke()
+		output = self.interpreter.get_tensor(self.output_detail["index"])
+
+		scale, zero_point = self.output_detail["quantization"]
+		if self.output_detail["dtype"] != np.float32:
+			output = (output.astype(np.float32) - zero_point) * scale
+
+		return output.reshape(-1)
@@ -0,0 +1,130 @@
+import os
+import hashlib
+import sqlite3
+
+class ScoreCacheInterface:
+	"""
+	A persistent cache of beauty scores stored in an sqlite3 database.
+	Each score is keyed by the content hash of the image file and the fingerprint of the model,
+	so renamed or moved crops are not scored twice and a retrained model never reuses old scores.
+
+	Attributes
+		connection:
+			An sqlite3 handler to connect with an sql database
+
+		cursor:
+			An sqlite3 cursor
+
+		model_fingerprint: str
+			Hash of the "saved_model.pb" and "variables/variables.index" files of the model,
+			or of the converted model file.
+	"""
+	def __init__(self, database_name = "score_cache.db", model_source = "./CNN_beauty_face_detection_model"):
+		"""
+		Connect to the score cache database and fingerprint the model.
+		Create the neccessary table if the database does not exist.
+
+		Parameter:
+			database_name: str
+				Name or path to the database.
+
+			model_source: str
+				Path to the SavedModel directory of the classifier, or to a converted model file.
+		"""
+		if os.path.isdir(model_source):
+			# The graph can stay the same when the model is retrained, the variable index changes with the weights
+			file_hashes = [ScoreCacheInterface.hash_file(f"{model_source}/{file_name}") for file_name in ["saved_model.pb", "variables/variables.index"]]
+			self.model_fingerprint = ScoreCacheInterface.hash_bytes("".join(file_hashes).encode("ascii"))
+		else:
+			self.model_fingerprint = ScoreCacheInterface.hash_file(model_source)
+
+		self.connection = sqlite3.connect(database_name)
+		self.cursor     = self.connection.cursor()
+
+		self.cursor.execute('''
+			CREATE TABLE IF NOT EXISTS Beauty_score(
+				content_hash		NOT NULL,
+				model_fingerprint	NOT NULL,
+				probability			NOT NULL,
+				PRIMARY KEY (content_hash, model_fingerprint)
+			)
+		''')
+
+		self.connection.commit()
+
+	def __del__(self):
+		"""
+		Disconnect from the database.
+		"""
+		self.connection.close()
+
+	@staticmethod
+	def hash_file(file_path, chunk_size = 1 << 20):
+		"""
+		Return the sha1 hex digest of a file content.
+
+		Parameter:
+			file_path: str
+
+			chunk_size: int
+				Number of bytes read at a time.
+		"""
+		hasher = hashlib.sha1()
+		with open(file_path, "rb") as file_handler:
+			for chunk in iter(lambda: file_handler.read(chunk_size), b""):
+				hasher.update(chunk)
+
+		return hasher.hexdigest()
+
+	@staticmethod
+	def hash_bytes(data):
+		"""
+		Return the sha1 hex digest of a file content that was already read, the same as hash_file.
+
+		Parameter:
+			data: bytes
+		"""
+		return hashlib.sha1(data).hexdigest()
+
+	def get_scores(self, content_hashes):
+		"""
+		Return a dictionary of content hash to probability for the hashes that are already scored
+		by the current model. Unseen hashes are not in the dictionary.
+
+		Parameter:
+			content_hashes: list of str
+		"""
+		scores = {}
+		content_hashes = list(content_hashes)
+		# Stay below the default sqlite limit of host parameters per query
+		for i in range(0, len(content_hashes), 900):
+			sub_hashes = content_hashes[i:i + 900]
+			self.cursor.execute(f'''
+				SELECT	content_hash, probability
+				FROM	Beauty_score
+				WHERE	model_fingerprint = ?
+				AND		content_hash IN ({",".join("?" * len(sub_hashes))})
+			''', [self.model_fingerprint] + sub_hashes)
+			scores.update(self.cursor.fetchall())
+
+		return scores
+
+	def add_scores(self, hash_and_probabilities):
+		"""
+		Store the raw probabilities of the current model.
+		Existing scores of the same content and model are replaced.
+
+		Parameter:
+			hash_and_probabilities: list of tuple (content_hash, probability)
+		"""
+		self.cursor.executemany('''
+			INSERT OR REPLACE
+			INTO Beauty_score (
+				content_hash,
+				model_fingerprint,
+				probability
+			)
+			VALUES (?, ?, ?)
+		''', [(content_hash, self.model_fingerprint, float(probability)) for content_hash, probability in hash_and_probabilities])
+
+		self.connection.commit()
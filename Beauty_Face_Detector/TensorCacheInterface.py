@@ -0,0 +1,108 @@
+import os
+import cv2
+import numpy as np
+
+class TensorCacheInterface:
+	"""
+	A cache of preprocessed classifier inputs stored in one memory-mapped uint8 .npy array,
+	with an index file that holds the relative path of each row.
+	Batches are read as views into the memory map, so repeated runs do not decode any image.
+
+	Attributes
+		images: numpy memmap
+			Array of shape (N, input_size, input_size, 3) in BGR order.
+
+		image_paths: list of str
+			Relative path of each row of images.
+	"""
+	def __init__(self, cache_path = "../Beauty_Tensor_Cache"):
+		"""
+		Open a cache created by TensorCacheInterface.build.
+
+		Parameter:
+			cache_path: str
+				Path of the cache without extension.
+				The cache consists of "{cache_path}.npy" and "{cache_path}_index.txt".
+		"""
+		self.images = np.load(f"{cache_path}.npy", mmap_mode = "r")
+		with open(f"{cache_path}_index.txt", "r", encoding = "utf8") as file_handler:
+			self.image_paths = file_handler.read().splitlines()
+
+		if len(self.image_paths) != len(self.images):
+			raise ValueError(f'''index of "{cache_path}" has {len(self.image_paths)} paths for {len(self.images)} images''')
+
+	def __len__(self):
+		return len(self.image_paths)
+
+	def iterate_batches(self, batch_size, start = 0, stop = None):
+		"""
+		Yield tuple of (list of relative path, uint8 array view) for rows in [start, stop).
+
+		Parameter:
+			batch_size: int
+
+			start: int
+
+			stop: int
+				None to read until the end of the cache.
+		"""
+		stop = len(self) if stop is None else min(stop, len(self))
+		for i in range(start, stop, batch_size):
+			j = min(i + batch_size, stop)
+			yield (self.image_paths[i:j], self.images[i:j])
+
+	@staticmethod
+	def build(source, image_paths, cache_path, input_size = 128, verbose = False):
+		"""
+		Decode and resize the images once and write them into a new cache.
+		Return the number of cached images. Images that cannot be read are left out.
+
+		Parameter:
+			source: str
+				Root directory of the images.
+
+			image_paths: list of str
+				Relative paths of the images under source.
+
+			cache_path: str
+				Path of the cache without extension.
+
+			input_size: int
+				Width and height of the network input.
+
+			verbose: bool
+		"""
+		temp_file = f"{cache_path}.tmp.npy"
+		images    = np.lib.format.open_memmap(temp_file, mode = "w+", dtype = np.uint8, shape = (len(image_paths), input_size, input_size, 3))
+
+		cached_paths = []
+		for i, image_path in enumerate(image_paths):
+			if verbose and i % 1000 == 0:
+				print(f"preprocess {i}/{len(image_paths)} images")
+
+			image = cv2.imread(f"{source}/{image_path}")
+			if image is None:
+				print(f'''Warning: could not open {source}/{image_path}''')
+				continue
+
+			images[len(cached_paths)] = cv2.resize(image, (input_size, input_size), interpolation = cv2.INTER_AREA)
+			cached_paths.append(image_path)
+
+		# Shrink the array when some images were left out
+		if len(cached_paths) != len(image_paths):
+			compact_file = f"{cache_path}.compact.npy"
+			compact = np.lib.format.open_memmap(compact_file, mode = "w+", dtype = np.uint8, shape = (len(cached_paths), input_size, input_size, 3))
+			compact[:] = images[:len(cached_paths)]
+			compact.flush()
+			del compact
+			del images
+			os.replace(compact_file, temp_file)
+		else:
+			images.flush()
+			del images
+
+		with open(f"{cache_path}_index.txt", "w", encoding = "utf8") as file_handler:
+			file_handler.write("".join(f"{image_path}\n" for image_path in cached_paths))
+		os.replace(temp_file, f"{cache_path}.npy")
+
+		return len(cached_paths)
@@ -0,0 +1,88 @@
+"""Compare accuracy and throughput of the TFLite backend against the Keras backend."""
+
+import os
+import time
+
+import click
+import cv2
+import numpy as np
+
+from BeautyClassifierInterface import BeautyClassifierInterface
+
+#----------------------------------------------------------------------------
+
+def measure_throughput(classifier, batch, batch_size, repeat):
+	"""
+	Return the probabilities of the batch and the number of images per second.
+	"""
+	probabilities = np.concatenate([classifier.predict(batch[i:i + batch_size]) for i in range(0, len(batch), batch_size)])
+
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for i in range(0, len(batch), batch_size):
+			classifier.predict(batch[i:i + batch_size])
+	elapsed = time.perf_counter() - start
+
+	return probabilities, repeat * len(batch) / elapsed
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--source', help='Directory of face crops', required=True, metavar='PATH')
+@click.option('--model', 'model_source', help='SavedModel directory', default='./CNN_beauty_face_detection_model', show_default=True)
+@click.option('--tflite', 'tflite_source', help='Converted .tflite file', default='./CNN_beauty_face_detection_model.tflite', show_default=True)
+@click.option('--num-images', help='Number of images to benchmark', type=int, default=1024, show_default=True)
+@click.option('--batch-size', help='Inference batch size', type=int, default=64, show_default=True)
+@click.option('--repeat', help='Number of timed passes over the images', type=int, default=3, show_default=True)
+@click.option('--intra-op-threads', help='Threads inside an operation (0 = runtime default)', type=int, default=0, show_default=True)
+@click.option('--inter-op-threads', help='Operations run in parallel (0 = runtime default)', type=int, default=0, show_default=True)
+@click.option('--threshold', help='Classification threshold', type=float, default=0.5, show_default=True)
+def benchmark_backend(
+	source: str,
+	model_source: str,
+	tflite_source: str,
+	num_images: int,
+	batch_size: int,
+	repeat: int,
+	intra_op_threads: int,
+	inter_op_threads: int,
+	threshold: float
+):
+	"""Check that the TFLite model agrees with the Keras model and compare their throughput.
+
+	\b
+	python benchmark_backend.py --source ../Crop_Image/high_resolution --intra-op-threads 8
+	"""
+	batch = []
+	for image_name in sorted(os.listdir(source)):
+		image = cv2.imread(f"{source}/{image_name}")
+		if image is None:
+			continue
+		batch.append(cv2.resize(image, (128, 128), interpolation = cv2.INTER_AREA))
+		if len(batch) == num_images:
+			break
+	batch = np.array(batch)
+	print(f"Loaded {len(batch)} images")
+
+	results = {}
+	for backend, path in [("keras", model_source), ("tflite", tflite_source)]:
+		start = time.perf_counter()
+		classifier = BeautyClassifierInterface(path, backend, intra_op_threads, inter_op_threads)
+		load_time = time.perf_counter() - start
+
+		probabilities, images_per_second = measure_throughput(classifier, batch, batch_size, repeat)
+		results[backend] = probabilities
+		print(f"{backend:6s}: load {load_time:6.2f} s, {images_per_second:8.1f} images/s")
+
+	difference = np.abs(results["keras"] - results["tflite"])
+	agreement  = np.mean((results["keras"] > threshold) == (results["tflite"] > threshold))
+	print(f"Max probability difference : {difference.max():.5f}")
+	print(f"Mean probability difference: {difference.mean():.5f}")
+	print(f"Prediction agreement       : {agreement * 100:.2f}%")
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	benchmark_backend() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
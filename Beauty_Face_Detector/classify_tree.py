@@ -0,0 +1,265 @@
+"""Classify every face crop of a directory tree with several worker processes."""
+
+import csv
+import hashlib
+import multiprocessing
+import os
+import re
+import socket
+import zlib
+from typing import List, Optional, Tuple
+
+import click
+import numpy as np
+
+#----------------------------------------------------------------------------
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+#----------------------------------------------------------------------------
+
+def parse_shard(s: str) -> Tuple[int, int]:
+	'''Accept a shard "i/N" where 0 <= i < N and return (i, N).'''
+
+	m = re.match(r'^(\d+)/(\d+)$', s)
+	if not m or int(m.group(1)) >= int(m.group(2)):
+		raise click.BadParameter(f'expected "i/N" with 0 <= i < N, got "{s}"')
+	return int(m.group(1)), int(m.group(2))
+
+#----------------------------------------------------------------------------
+
+def list_images(source: str) -> List[str]:
+	'''Return the sorted relative paths of all images under source.'''
+
+	image_paths = []
+	for root, _, file_names in os.walk(source):
+		for file_name in file_names:
+			if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+				image_paths.append(os.path.relpath(os.path.join(root, file_name), source).replace('\\', '/'))
+	return sorted(image_paths)
+
+#----------------------------------------------------------------------------
+
+def shard_of(image_path: str, num_shards: int, num_workers: int) -> Tuple[int, int]:
+	'''Return the (shard, worker) that owns an image.
+	The owner only depends on the path, so it does not change when images are added or removed.'''
+
+	key = zlib.crc32(image_path.encode('utf8'))
+	return key % num_shards, (key // num_shards) % num_workers
+
+#----------------------------------------------------------------------------
+
+def write_rows(file_name: str, rows: List[Tuple[str, float, int]]):
+	'''Write result rows to a csv file atomically.
+	The temporary file is private to this process and host, machines that finish at the same time may write the same file.'''
+
+	tmp_name = f'{file_name}.{socket.gethostname()}.{os.getpid()}.tmp'
+	with open(tmp_name, 'w', newline='') as file_handler:
+		writer = csv.writer(file_handler)
+		writer.writerow(['path', 'probability', 'prediction'])
+		writer.writerows(rows)
+	os.replace(tmp_name, file_name)
+
+def read_rows(file_name: str) -> List[Tuple[str, float, int]]:
+	with open(file_name, 'r', newline='') as file_handler:
+		reader = csv.reader(file_handler)
+		next(reader)
+		return [(path, float(probability), int(prediction)) for path, probability, prediction in reader]
+
+#----------------------------------------------------------------------------
+
+def run_id_of(image_paths: List[str], model_source: str, backend: str, threshold: float) -> str:
+	'''Return an id of the image list and the settings of a job, the same on every machine that runs it.'''
+
+	sha1 = hashlib.sha1()
+	sha1.update(f'{model_source}\n{backend}\n{threshold!r}\n'.encode('utf8'))
+	for image_path in image_paths:
+		sha1.update(image_path.encode('utf8') + b'\n')
+	return sha1.hexdigest()[:12]
+
+#----------------------------------------------------------------------------
+
+def classify_tensor_cache(job: dict, classifier) -> List[Tuple[str, float, int]]:
+	'''Score a range of rows of a tensor cache, reading the batches as views into the memory map.'''
+
+	from TensorCacheInterface import TensorCacheInterface
+
+	tensor_cache = TensorCacheInterface(job['tensor_cache'])
+	start, stop = job['index_range']
+
+	rows = []
+	for sub_paths, batch in tensor_cache.iterate_batches(job['batch_size'], start, stop):
+		probabilities = classifier.predict(batch)
+		rows += [(image_path, float(probability), 1 if probability > job['threshold'] else 0) for image_path, probability in zip(sub_paths, probabilities)]
+	return rows
+
+#----------------------------------------------------------------------------
+
+def classify_worker(job: dict) -> str:
+	'''Load the model once and score the images of one worker shard.'''
+
+	from BeautyClassifierInterface import BeautyClassifierInterface
+	import cv2
+
+	classifier = BeautyClassifierInterface(job['model_source'], job['backend'], job['intra_op_threads'], 1)
+	if job['tensor_cache'] is not None:
+		write_rows(job['result_file'], classify_tensor_cache(job, classifier))
+		return job['result_file']
+
+	score_cache = None
+	if job['cache_path'] is not None:
+		from ScoreCacheInterface import ScoreCacheInterface
+		score_cache = ScoreCacheInterface(job['cache_path'], job['model_source'])
+
+	rows = []
+	image_paths = job['image_paths']
+	for i in range(0, len(image_paths), job['batch_size']):
+		sub_paths = image_paths[i:i + job['batch_size']]
+		file_paths = [f"{job['source']}/{image_path}" for image_path in sub_paths]
+
+		# Every file is read once, for both the hash and the decoder
+		contents = []
+		for file_path in file_paths:
+			with open(file_path, 'rb') as file:
+				contents.append(file.read())
+
+		scores = {}
+		content_hashes = None
+		if score_cache is not None:
+			content_hashes = [ScoreCacheInterface.hash_bytes(content) for content in contents]
+			scores = score_cache.get_scores(content_hashes)
+
+		batch = []
+		unseen_index = []
+		for j, file_path in enumerate(file_paths):
+			if content_hashes is not None and content_hashes[j] in scores:
+				continue
+			image = cv2.imdecode(np.frombuffer(contents[j], dtype=np.uint8), cv2.IMREAD_COLOR)
+			if image is None:
+				print(f'''Warning: could not open {file_path}''')
+				continue
+			batch.append(classifier.preprocess(image))
+			unseen_index.append(j)
+
+		probabilities = classifier.predict(np.array(batch))
+		new_scores = {j: float(probability) for j, probability in zip(unseen_index, probabilities)}
+		if score_cache is not None:
+			score_cache.add_scores([(content_hashes[j], probability) for j, probability in new_scores.items()])
+			new_scores.update({j: scores[content_hash] for j, content_hash in enumerate(content_hashes) if content_hash in scores})
+
+		for j in sorted(new_scores):
+			rows.append((sub_paths[j], new_scores[j], 1 if new_scores[j] > job['threshold'] else 0))
+
+	write_rows(job['result_file'], rows)
+	return job['result_file']
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--source', help='Root directory of the face crops', metavar='PATH')
+@click.option('--outdir', help='Directory for the result files', required=True, metavar='PATH')
+@click.option('--workers', help='Number of worker processes on this machine', type=int, default=max(1, os.cpu_count() // 4), show_default=True)
+@click.option('--shard', help='Only classify shard i of N, for spreading a job across machines', type=parse_shard, default='0/1', show_default=True)
+@click.option('--model', 'model_source', help='SavedModel directory or .tflite file', default='./CNN_beauty_face_detection_model', show_default=True)
+@click.option('--backend', help='Inference backend', type=click.Choice(['keras', 'tflite']), default='keras', show_default=True)
+@click.option('--batch-size', help='Inference batch size', type=int, default=256, show_default=True)
+@click.option('--threshold', help='Classification threshold', type=float, default=0.5, show_default=True)
+@click.option('--cache', 'cache_path', help='Score cache database shared by the workers', metavar='PATH')
+@click.option('--tensor-cache', help='Read preprocessed inputs from a cache made by preprocess_cache.py instead of --source', metavar='PATH')
+def classify_tree(
+	source: Optional[str],
+	outdir: str,
+	workers: int,
+	shard: Tuple[int, int],
+	model_source: str,
+	backend: str,
+	batch_size: int,
+	threshold: float,
+	cache_path: Optional[str],
+	tensor_cache: Optional[str]
+):
+	"""Classify every face crop under a directory tree with several worker processes.
+
+	Images are assigned to shards by a hash of their relative path. Each worker
+	writes its own result file, the files of a shard are merged into
+	scores_shard_i_of_N_run_ID.csv, and the machine that completes the last shard
+	merges all shards into scores.csv. ID identifies the image list, model,
+	backend and threshold, so shard files left over from another run are never
+	merged. Use --cache so that a restarted job does not score
+	the same crops again.
+
+	With --tensor-cache, no image is decoded. The rows of the cache are split into
+	contiguous ranges per shard and worker, and the score cache is not used.
+
+	\b
+	python classify_tree.py --source ../Crop_Image --outdir ../Beauty_Score --workers 8
+	python classify_tree.py --source ../Crop_Image --outdir ../Beauty_Score --shard 2/4
+	"""
+	shard_id, num_shards = shard
+	if (source is None) == (tensor_cache is None):
+		raise click.UsageError('specify exactly one of --source and --tensor-cache')
+	os.makedirs(outdir, exist_ok=True)
+
+	worker_paths = [[] for _ in range(workers)]
+	worker_ranges = [None for _ in range(workers)]
+	if tensor_cache is not None:
+		from TensorCacheInterface import TensorCacheInterface
+		cache_paths = TensorCacheInterface(tensor_cache).image_paths
+		run_id = run_id_of(cache_paths, model_source, backend, threshold)
+		num_rows = len(cache_paths)
+		shard_start = num_rows * shard_id // num_shards
+		shard_stop = num_rows * (shard_id + 1) // num_shards
+		for worker_id in range(workers):
+			worker_ranges[worker_id] = (shard_start + (shard_stop - shard_start) * worker_id // workers, shard_start + (shard_stop - shard_start) * (worker_id + 1) // workers)
+		print(f'Shard {shard_id}/{num_shards}: {shard_stop - shard_start} cached images for {workers} workers')
+	else:
+		print(f'Listing images in "{source}" ...')
+		image_paths = list_images(source)
+		run_id = run_id_of(image_paths, model_source, backend, threshold)
+		for image_path in image_paths:
+			image_shard, worker_id = shard_of(image_path, num_shards, workers)
+			if image_shard == shard_id:
+				worker_paths[worker_id].append(image_path)
+		print(f'Shard {shard_id}/{num_shards}: {sum(len(paths) for paths in worker_paths)} images for {workers} workers')
+
+	jobs = [dict(
+		source=source,
+		image_paths=worker_paths[worker_id],
+		tensor_cache=tensor_cache,
+		index_range=worker_ranges[worker_id],
+		result_file=f'{outdir}/scores_shard_{shard_id}_of_{num_shards}_worker_{worker_id}_of_{workers}.csv',
+		model_source=model_source,
+		backend=backend,
+		intra_op_threads=max(1, os.cpu_count() // workers),
+		batch_size=batch_size,
+		threshold=threshold,
+		cache_path=cache_path
+	) for worker_id in range(workers)]
+
+	# Spawn the workers so none of them inherits a half initialized TensorFlow
+	with multiprocessing.get_context('spawn').Pool(workers) as pool:
+		for result_file in pool.imap_unordered(classify_worker, jobs):
+			print(f'Finished "{result_file}"')
+
+	rows = []
+	for job in jobs:
+		rows += read_rows(job['result_file'])
+	write_rows(f'{outdir}/scores_shard_{shard_id}_of_{num_shards}_run_{run_id}.csv', sorted(rows))
+
+	shard_files = [f'{outdir}/scores_shard_{i}_of_{num_shards}_run_{run_id}.csv' for i in range(num_shards)]
+	missing = [i for i, shard_file in enumerate(shard_files) if not os.path.isfile(shard_file)]
+	if missing:
+		print(f'Run {run_id}: waiting for shards {", ".join(str(i) for i in missing)} before merging')
+	else:
+		rows = []
+		for shard_file in shard_files:
+			rows += read_rows(shard_file)
+		write_rows(f'{outdir}/scores.csv', sorted(rows))
+		print(f'Merged {num_shards} shards into "{outdir}/scores.csv"')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	classify_tree() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
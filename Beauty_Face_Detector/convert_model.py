@@ -0,0 +1,71 @@
+"""Convert the CNN beauty face detection model into a TFLite model for CPU inference."""
+
+import os
+import random
+
+import click
+import cv2
+import numpy as np
+import tensorflow as tf
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--model', 'model_source', help='SavedModel directory', default='./CNN_beauty_face_detection_model', show_default=True)
+@click.option('--dest', help='Output .tflite file', default='./CNN_beauty_face_detection_model.tflite', show_default=True)
+@click.option('--int8', 'int8', is_flag=True, help='Apply full integer quantization')
+@click.option('--calibration', help='Directory of face crops used to calibrate the int8 quantization', metavar='PATH')
+@click.option('--num-calibration', help='Number of calibration images', type=int, default=500, show_default=True)
+@click.option('--input-size', help='Network input width and height', type=int, default=128, show_default=True)
+def convert_model(
+	model_source: str,
+	dest: str,
+	int8: bool,
+	calibration: str,
+	num_calibration: int,
+	input_size: int
+):
+	"""Convert the CNN beauty face detection model into a TFLite model.
+
+	The conversion only needs to run once. Use BeautyClassifierInterface with
+	backend="tflite" to run the converted model, and benchmark_backend.py to
+	check its accuracy and throughput against the Keras model.
+
+	\b
+	python convert_model.py --int8 --calibration ../Crop_Image/high_resolution
+	"""
+	converter = tf.lite.TFLiteConverter.from_saved_model(model_source)
+
+	if int8:
+		if calibration is None:
+			raise click.UsageError('--calibration is required with --int8')
+
+		image_names = sorted(os.listdir(calibration))
+		random.Random(0).shuffle(image_names)
+		image_names = image_names[:num_calibration]
+
+		def representative_dataset():
+			for image_name in image_names:
+				image = cv2.imread(f"{calibration}/{image_name}")
+				if image is None:
+					continue
+				image = cv2.resize(image, (input_size, input_size), interpolation = cv2.INTER_AREA)
+				yield [image[np.newaxis].astype(np.float32) * (1. / 255)]
+
+		converter.optimizations = [tf.lite.Optimize.DEFAULT]
+		converter.representative_dataset = representative_dataset
+		converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+		converter.inference_input_type  = tf.int8
+		converter.inference_output_type = tf.int8
+
+	tflite_model = converter.convert()
+	with open(dest, 'wb') as file_handler:
+		file_handler.write(tflite_model)
+	print(f'Saved {"int8" if int8 else "float"} model to "{dest}" ({len(tflite_model) / 2**20:.2f} MB)')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	convert_model() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
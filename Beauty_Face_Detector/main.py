@@ -2,27 +2,40 @@ import os, sys
 import cv2, pickle
 import random
 import numpy as np
-from tensorflow import keras
+
+from BeautyClassifierInterface import BeautyClassifierInterface
+from ScoreCacheInterface import ScoreCacheInterface
 
 if __name__ == "__main__":
 	INPUT_IMAGE_SIZE = 128
+	THRESHOLD        = 0.5
 	# source       = "../Crop_Image/high_resolution"
 	# destination  = "../Classified_Image"
 	source       = "../Classified_Image/manual please"
 	destination  = "../Classified_Image/manual result"
 	model_source = "./CNN_beauty_face_detection_model"
+	cache_path   = "../Beauty_Score_Cache.db"
+	# Use "tflite" with the model made by convert_model.py on CPU-only nodes
+	backend          = "keras"
+	backend_source   = model_source
+	intra_op_threads = 0
+	inter_op_threads = 0
+
+	score_cache = ScoreCacheInterface(cache_path, backend_source)
 
 	def create_image_data_generator():
 		for image_name in os.listdir(source):
-			input_file_path = f"{source}/{image_name}"
-			original_image  = cv2.imread(input_file_path)
-			resized_image   = cv2.resize(original_image, (INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE), interpolation = cv2.INTER_AREA)
-			
-			yield (original_image, resized_image, image_name)
+			# Read the crop once for both the hash and the decoder
+			with open(f"{source}/{image_name}", "rb") as file_handler:
+				content = file_handler.read()
+			original_image  = cv2.imdecode(np.frombuffer(content, dtype = np.uint8), cv2.IMREAD_COLOR)
+			content_hash    = ScoreCacheInterface.hash_bytes(content)
+
+			yield (original_image, content_hash, image_name)
 
 	image_data_generator = create_image_data_generator()
 
-	CNN_beauty_face_detection_model = keras.models.load_model(model_source)
+	CNN_beauty_face_detection_model = None
 	batch_size = 1024
 
 	while True:
@@ -36,14 +49,28 @@ if __name__ == "__main__":
 
 		final_batch_size = len(images_data)
 		if final_batch_size == 0:
-			break 
+			break
+
+		# Only the crops that are not in the cache go through the network
+		scores       = score_cache.get_scores([content_hash for _, content_hash, _ in images_data])
+		unseen_index = [i for i, (_, content_hash, _) in enumerate(images_data) if content_hash not in scores]
+		print(f"Found {final_batch_size - len(unseen_index)} cached scores, classify {len(unseen_index)} images")
+
+		if unseen_index:
+			if CNN_beauty_face_detection_model is None:
+				CNN_beauty_face_detection_model = BeautyClassifierInterface(backend_source, backend, intra_op_threads, inter_op_threads, INPUT_IMAGE_SIZE)
+
+			batch = [CNN_beauty_face_detection_model.preprocess(images_data[i][0]) for i in unseen_index]
+			batch = np.array(batch)
 
-		batch = [resized_image * (1. / 255) for _, resized_image, _ in images_data]
-		batch = np.array(batch)
+			probabilities = CNN_beauty_face_detection_model.predict(batch)
+			probabilities = [float(probability) for probability in probabilities]
+			new_scores    = [(images_data[i][1], probability) for i, probability in zip(unseen_index, probabilities)]
+			score_cache.add_scores(new_scores)
+			scores.update(new_scores)
 
-		predictions = CNN_beauty_face_detection_model.predict(batch)
-		predictions = [1 if prediction > 0.5 else 0 for prediction in predictions]
+		predictions = [1 if scores[content_hash] > THRESHOLD else 0 for _, content_hash, _ in images_data]
 
 		for i in range(len(predictions)):
 			output_file_path = f"{destination}/{predictions[i]}_by_computer/{images_data[i][2]}"
-			cv2.imwrite(output_file_path, images_data[i][0])
\ No newline at end of file
+			cv2.imwrite(output_file_path, images_data[i][0])
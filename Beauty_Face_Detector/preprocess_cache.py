@@ -0,0 +1,38 @@
+"""Preprocess every face crop of a directory tree into a memory-mapped tensor cache."""
+
+import click
+
+from classify_tree import list_images
+from TensorCacheInterface import TensorCacheInterface
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--source', help='Root directory of the face crops', required=True, metavar='PATH')
+@click.option('--dest', help='Path of the cache without extension', default='../Beauty_Tensor_Cache', show_default=True, metavar='PATH')
+@click.option('--input-size', help='Network input width and height', type=int, default=128, show_default=True)
+def preprocess_cache(
+	source: str,
+	dest: str,
+	input_size: int
+):
+	"""Decode and resize every face crop once into DEST.npy and DEST_index.txt.
+
+	Use the cache with classify_tree.py --tensor-cache, or open it with
+	TensorCacheInterface in evaluation tools, to run the classifier again
+	without decoding any image.
+
+	\b
+	python preprocess_cache.py --source ../Crop_Image/high_resolution
+	"""
+	print(f'Listing images in "{source}" ...')
+	image_paths = list_images(source)
+	num_images  = TensorCacheInterface.build(source, image_paths, dest, input_size, verbose=True)
+	print(f'Cached {num_images} of {len(image_paths)} images into "{dest}.npy"')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	preprocess_cache() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
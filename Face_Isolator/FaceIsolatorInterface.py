@@ -1,5 +1,6 @@
 import os
 import cv2
+import json
 
 class FaceIsolatorInterface:
 	"""
@@ -24,9 +25,12 @@ class FaceIsolatorInterface:
 		
 		verbose:
 			True if we want to display log message
+
+		face_box_path:
+			JSON lines file that records the face box of every written face, or None
 	"""
 	def __init__(self, source = "./data", destination = "./result", 
-		output_config = [], show_box = False, verbose = False):
+		output_config = [], show_box = False, verbose = False, face_box_path = None):
 		"""
 		Initiate the detectors. 
 		Create the source and destination directory if needed.
@@ -44,11 +48,17 @@ class FaceIsolatorInterface:
 			show_box: bool
 
 			verbose: bool
+
+			face_box_path: str
+				If set, append a line {"name": file name, "size": face image size, "face": [x, y, w, h]}
+				to this file for every written face, where the face box is relative to the face image.
+				The dataset tool uses it with --transform face-align.
 		"""
 		self.face_detector = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
 		self.eye_detector  = cv2.CascadeClassifier("haarcascade_eye.xml")
 		self.show_box = show_box
 		self.verbose  = verbose
+		self.face_box_path = face_box_path
 
 		if not os.path.exists(source):
 			os.makedirs(source)
@@ -196,9 +206,12 @@ class FaceIsolatorInterface:
 
 		return result
 			
-	def export_results(self, original_image_name, image, faces_and_eyes_info, face_ratio = 1.6):
+	def crop_faces(self, original_image_name, image, faces_and_eyes_info, face_ratio = 1.6):
 		"""
-		Export image to the coresponding directory setup in output_config
+		Yield a tuple of (output_path, face_image, face_box) for each face,
+		where output_path is the coresponding directory setup in output_config,
+		face_image is a view into the original image
+		and face_box is the (x, y, w, h) of the face in face_image.
 
 		Parameter:
 			original_image_name: str
@@ -213,9 +226,6 @@ class FaceIsolatorInterface:
 			face_ratio: float
 				The minimum ratio of face and image
 		"""
-		if len(faces_and_eyes_info) == 0:
-			return
-
 		image_w = image.shape[1]
 		image_h = image.shape[0]
 
@@ -253,7 +263,52 @@ class FaceIsolatorInterface:
 				for eye_x, eye_y, eye_w, eye_h  in eyes:
 					cv2.rectangle(image, (eye_x, eye_y), (eye_x + eye_w, eye_y + eye_h), (0, 0, 255), 2)
 
-			try:
-				cv2.imwrite(output_path, image[output_y:output_y + output_size:, output_x:output_x + output_size:, ::])
-			except:
-				print(f'''Warning: fail to write "{output_path}"''')
\ No newline at end of file
+			face_box = (int(face_x - output_x), int(face_y - output_y), int(face_w), int(face_h))
+			yield (output_path, image[output_y:output_y + output_size:, output_x:output_x + output_size:, ::], face_box)
+
+	def export_results(self, original_image_name, image, faces_and_eyes_info, face_ratio = 1.6):
+		"""
+		Export image to the coresponding directory setup in output_config
+
+		Parameter:
+			original_image_name: str
+				
+			image: numpy array
+				The original image
+
+			faces_and_eyes_info: list of tuple where each tuple contain 
+				(face, list of eye)
+				Where face and eye has the form (x, y, w, h)
+
+			face_ratio: float
+				The minimum ratio of face and image
+		"""
+		if len(faces_and_eyes_info) == 0:
+			return
+
+		for output_path, face_image, face_box in self.crop_faces(original_image_name, image, faces_and_eyes_info, face_ratio):
+			self.write_face(output_path, face_image, face_box)
+
+	def write_face(self, output_path, face_image, face_box = None):
+		"""
+		Write a face image and give a warning if it fails.
+		Record its face box in face_box_path if both are set.
+
+		Parameter:
+			output_path: str
+
+			face_image: numpy array
+
+			face_box: tuple of (x, y, w, h)
+				The face in face_image.
+		"""
+		try:
+			cv2.imwrite(output_path, face_image)
+		except:
+			print(f'''Warning: fail to write "{output_path}"''')
+			return
+
+		if self.face_box_path is not None and face_box is not None:
+			with open(self.face_box_path, "a", encoding = "utf8") as file_handler:
+				record = {"name": os.path.basename(output_path), "size": face_image.shape[1], "face": list(face_box)}
+				file_handler.write(json.dumps(record) + "\n")
\ No newline at end of file
@@ -0,0 +1,64 @@
+import sys
+import numpy as np
+
+from FaceIsolatorInterface import FaceIsolatorInterface
+
+sys.path.append("../Beauty_Face_Detector")
+from BeautyClassifierInterface import BeautyClassifierInterface
+
+if __name__ == "__main__":
+	# Crop and score in one pass: the crops are handed in memory to the beauty classifier
+	# and only the crops above the threshold are written to disk.
+	THRESHOLD    = 0.5
+	batch_size   = 256
+	model_source = "../Beauty_Face_Detector/CNN_beauty_face_detection_model"
+	backend      = "keras"
+
+	face_isolator = FaceIsolatorInterface("../Original_Image", "../Crop_Image", output_config = [128, 256], show_box = False, verbose = True,
+		face_box_path = "../Crop_Image/face_boxes.jsonl")
+	classifier    = BeautyClassifierInterface(model_source, backend)
+
+	pending_faces = []
+	kept_count    = 0
+	scored_count  = 0
+
+	def score_and_export(pending_faces):
+		"""
+		Score the pending faces in one batch and write those above the threshold.
+		Return the number of written faces.
+		"""
+		batch         = np.array([classifier.preprocess(face_image) for _, face_image, _ in pending_faces])
+		probabilities = classifier.predict(batch)
+
+		kept_count = 0
+		for (output_path, face_image, face_box), probability in zip(pending_faces, probabilities):
+			if probability > THRESHOLD:
+				face_isolator.write_face(output_path, face_image, face_box)
+				kept_count += 1
+
+		return kept_count
+
+	while True:
+		try:
+			name, image, gray = next(face_isolator.image_generator)
+		except StopIteration:
+			break
+
+		faces_info = face_isolator.detect_face_with_eye(image, gray)
+		if faces_info == -1:
+			continue
+
+		# Copy the crops so the original image can be freed before the batch is scored
+		for output_path, face_image, face_box in face_isolator.crop_faces(name, image, faces_info):
+			pending_faces.append((output_path, face_image.copy(), face_box))
+
+		if len(pending_faces) >= batch_size:
+			kept_count   += score_and_export(pending_faces)
+			scored_count += len(pending_faces)
+			pending_faces = []
+
+	if pending_faces:
+		kept_count   += score_and_export(pending_faces)
+		scored_count += len(pending_faces)
+
+	print(f"Kept {kept_count} of {scored_count} faces")
@@ -6,7 +6,8 @@ if __name__ == "__main__":
 	# except:
 	# 	pass
 	
-	face_isolator = FaceIsolatorInterface("../Original_Image", "../Crop_Image", output_config = [128, 256], show_box = False, verbose = True)
+	face_isolator = FaceIsolatorInterface("../Original_Image", "../Crop_Image", output_config = [128, 256], show_box = False, verbose = True,
+		face_box_path = "../Crop_Image/face_boxes.jsonl")
 
 	while True:
 		try:
@@ -6,17 +6,28 @@
 # distribution of this software and related documentation without an express
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
+import collections
+import concurrent.futures
+import contextlib
 import functools
+import hashlib
 import io
 import json
 import os
 import pickle
+import queue
+import re
+import socket
 import sys
 import tarfile
+import threading
+import time
+import warnings
 import gzip
 import zipfile
+import zlib
 from pathlib import Path
-from typing import Callable, Optional, Tuple, Union
+from typing import Callable, Iterator, List, Optional, Set, Tuple, Union
 
 import click
 import numpy as np
@@ -49,8 +60,70 @@ def is_image_ext(fname: Union[str, Path]) -> bool:
 
 #----------------------------------------------------------------------------
 
-def open_image_folder(source_dir, *, max_images: Optional[int]):
-    input_images = [str(f) for f in sorted(Path(source_dir).rglob('*')) if is_image_ext(f) and os.path.isfile(f)]
+def iterate_image_files(source_dir: str, dir_index: Optional[dict] = None, visited: Optional[Set[str]] = None) -> Iterator[str]:
+    '''Yield the relative paths of all images under source_dir in sorted path order.
+
+    Directories are listed one at a time with os.scandir, whose entries know
+    their type without a stat call, so the first images are yielded before the
+    whole tree is listed.  If dir_index is given, it maps each relative directory
+    to its mtime and sorted entries: directories whose mtime did not change are
+    not listed again, and the others are updated in place.  The relative
+    directories that were visited are added to visited.'''
+
+    def scan(rel_dir: str) -> Iterator[str]:
+        full_dir = os.path.join(source_dir, rel_dir)
+        if visited is not None:
+            visited.add(rel_dir)
+
+        entries = None
+        if dir_index is not None:
+            mtime_ns = os.stat(full_dir).st_mtime_ns
+            cached = dir_index.get(rel_dir)
+            if cached is not None and cached['mtime_ns'] == mtime_ns:
+                entries = cached['entries']
+
+        if entries is None:
+            entries = []
+            with os.scandir(full_dir) as it:
+                for entry in it:
+                    # Like Path.rglob, do not descend into symlinked directories.
+                    if entry.is_dir(follow_symlinks=False):
+                        entries.append([entry.name, True])
+                    elif entry.is_file() and is_image_ext(entry.name):
+                        entries.append([entry.name, False])
+            # Sorting every directory on its own gives the same order as sorting all paths.
+            entries.sort()
+            if dir_index is not None:
+                dir_index[rel_dir] = dict(mtime_ns=mtime_ns, entries=entries)
+
+        for name, is_dir in entries:
+            rel_path = name if rel_dir == '' else f'{rel_dir}/{name}'
+            if is_dir:
+                yield from scan(rel_path)
+            else:
+                yield rel_path
+
+    yield from scan('')
+
+#----------------------------------------------------------------------------
+
+def open_image_folder(source_dir, *, max_images: Optional[int], index_fname: Optional[str] = None):
+    if index_fname is not None:
+        # Refresh the persisted index, only listing the directories that changed.
+        dir_index = {}
+        if os.path.isfile(index_fname):
+            with open(index_fname, 'r') as file:
+                dir_index = json.load(file)
+        visited = set()
+        input_images = list(iterate_image_files(source_dir, dir_index, visited))
+        with open(index_fname + '.tmp', 'w') as file:
+            json.dump({ k: v for k, v in dir_index.items() if k in visited }, file)
+        os.replace(index_fname + '.tmp', index_fname)
+        max_idx = maybe_min(len(input_images), max_images)
+    else:
+        # Stream the listing.  The number of images is unknown until the end.
+        input_images = iterate_image_files(source_dir)
+        max_idx = max_images
 
     # Load labels.
     labels = {}
@@ -63,21 +136,181 @@ def open_image_folder(source_dir, *, max_images: Optional[int]):
             else:
                 labels = {}
 
-    max_idx = maybe_min(len(input_images), max_images)
-
     def iterate_images():
-        for idx, fname in enumerate(input_images):
-            arch_fname = os.path.relpath(fname, source_dir)
-            arch_fname = arch_fname.replace('\\', '/')
-            img = np.array(PIL.Image.open(fname))
-            yield dict(img=img, label=labels.get(arch_fname))
-            if idx >= max_idx-1:
+        for idx, arch_fname in enumerate(input_images):
+            if max_idx is not None and idx >= max_idx:
                 break
+            # Reading and decoding are deferred so that they can run in the encode workers.
+            yield dict(path=os.path.join(source_dir, arch_fname), name=arch_fname, label=labels.get(arch_fname))
     return max_idx, iterate_images()
 
 #----------------------------------------------------------------------------
 
-def open_image_zip(source, *, max_images: Optional[int]):
+class ReadStats:
+    '''Counters of the prefetching reader, shared by its threads.'''
+
+    def __init__(self):
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+        self.decoded = 0
+        self.decode_seconds = 0.0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add_read(self, num_bytes: int, seconds: float):
+        with self.lock:
+            self.read_bytes += num_bytes
+            self.read_seconds += seconds
+
+    def add_decode(self, seconds: float):
+        with self.lock:
+            self.decoded += 1
+            self.decode_seconds += seconds
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        return (f'read {self.read_bytes / 2**20 / elapsed:.1f} MB/s ({self.read_seconds:.1f} s reading), '
+            f'decode {self.decoded / elapsed:.1f} images/s ({self.decode_seconds:.1f} s decoding)')
+
+#----------------------------------------------------------------------------
+
+class UInt64Set:
+    '''Set of 64-bit hashes in one open addressing NumPy table of 8-byte slots.
+    The table is kept at most half full, so an entry takes 16 to 32 bytes
+    instead of about 100 for a Python set of ints.'''
+
+    def __init__(self, capacity: int = 1 << 16):
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.count = 0
+
+    def add(self, key: int) -> bool:
+        '''Add key and return False if it was already in the set.'''
+        key = key or 1 # 0 marks an empty slot.
+        if (self.count + 1) * 2 > len(self.table):
+            self._grow()
+        mask = len(self.table) - 1
+        slot = key & mask
+        while self.table[slot] != 0:
+            if self.table[slot] == key:
+                return False
+            slot = (slot + 1) & mask
+        self.table[slot] = key
+        self.count += 1
+        return True
+
+    def _grow(self):
+        keys = self.table[self.table != 0]
+        self.table = np.zeros(len(self.table) * 2, dtype=np.uint64)
+        self.count = 0
+        for key in keys.tolist():
+            self.add(key)
+
+#----------------------------------------------------------------------------
+
+def dedupe_key(dedupe: str, img: np.ndarray, source_hash: Optional[str]) -> int:
+    '''Return the 64-bit hash that identifies duplicates of a decoded image.
+
+    'exact' uses the sha1 of the source file if there is one and a hash of the
+    pixels otherwise.  'perceptual' uses a difference hash of the 9x8 grayscale
+    thumbnail, which usually stays the same for resized or re-encoded copies.'''
+
+    if dedupe == 'exact':
+        if source_hash is not None:
+            return int(source_hash[:16], 16)
+        pixels = hashlib.blake2b(repr(img.shape).encode('utf8'), digest_size=8)
+        pixels.update(np.ascontiguousarray(img))
+        return int.from_bytes(pixels.digest(), 'little')
+    assert dedupe == 'perceptual', 'unknown dedupe mode'
+    thumbnail = np.array(PIL.Image.fromarray(img).convert('L').resize((9, 8), PIL.Image.BOX), dtype=np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+#----------------------------------------------------------------------------
+
+def prefetch_decode(
+    read_raw: Callable[[], Iterator[Tuple[bytes, dict]]],
+    decode: Callable[[bytes], Optional[np.ndarray]],
+    threads: int,
+    stats: ReadStats
+) -> Iterator[dict]:
+    '''Yield dict(img=decode(raw), **meta) for every (raw, meta) from read_raw() in order.
+
+    A reader thread runs read_raw() sequentially, so a single zip handle or LMDB
+    transaction is used by one thread only, and hands the raw bytes to a pool of
+    decode threads.  A bounded queue limits how far the reader runs ahead.
+    Images that decode to None are skipped.  With threads=0 everything runs in
+    the calling thread.'''
+
+    def timed_read():
+        raw_iter = read_raw()
+        while True:
+            start = time.perf_counter()
+            try:
+                raw, meta = next(raw_iter)
+            except StopIteration:
+                return
+            stats.add_read(len(raw), time.perf_counter() - start)
+            yield raw, meta
+
+    def timed_decode(raw):
+        start = time.perf_counter()
+        img = decode(raw)
+        stats.add_decode(time.perf_counter() - start)
+        return img
+
+    if threads <= 0:
+        for raw, meta in timed_read():
+            img = timed_decode(raw)
+            if img is not None:
+                yield dict(img=img, **meta)
+        return
+
+    pending = queue.Queue(maxsize=threads * 4)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        def reader():
+            try:
+                for raw, meta in timed_read():
+                    if not put((executor.submit(timed_decode, raw), meta)):
+                        return
+                put((None, None))
+            except BaseException as e: # pylint: disable=broad-except
+                put((None, e))
+
+        reader_thread = threading.Thread(target=reader, daemon=True)
+        reader_thread.start()
+        try:
+            while True:
+                future, meta = pending.get()
+                if future is None:
+                    if meta is not None:
+                        raise meta
+                    break
+                img = future.result()
+                if img is not None:
+                    yield dict(img=img, **meta)
+        finally:
+            stop.set()
+            reader_thread.join()
+
+#----------------------------------------------------------------------------
+
+def decode_image_bytes(data: bytes) -> np.ndarray:
+    return np.array(PIL.Image.open(io.BytesIO(data)))
+
+#----------------------------------------------------------------------------
+
+def open_image_zip(source, *, max_images: Optional[int], decode_threads: int = 0, stats: Optional[ReadStats] = None):
     with zipfile.ZipFile(source, mode='r') as z:
         input_images = [str(f) for f in sorted(z.namelist()) if is_image_ext(f)]
 
@@ -93,44 +326,46 @@ def open_image_zip(source, *, max_images: Optional[int]):
 
     max_idx = maybe_min(len(input_images), max_images)
 
-    def iterate_images():
+    def read_raw():
         with zipfile.ZipFile(source, mode='r') as z:
-            for idx, fname in enumerate(input_images):
-                with z.open(fname, 'r') as file:
-                    img = PIL.Image.open(file) # type: ignore
-                    img = np.array(img)
-                yield dict(img=img, label=labels.get(fname))
-                if idx >= max_idx-1:
-                    break
-    return max_idx, iterate_images()
+            for fname in input_images[:max_idx]:
+                yield z.read(fname), dict(label=labels.get(fname))
+
+    return max_idx, prefetch_decode(read_raw, decode_image_bytes, decode_threads, stats or ReadStats())
 
 #----------------------------------------------------------------------------
 
-def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
+def decode_lmdb_image(value: bytes) -> Optional[np.ndarray]:
     import cv2  # pip install opencv-python
+
+    try:
+        try:
+            img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), 1)
+            if img is None:
+                raise IOError('cv2.imdecode failed')
+            img = img[:, :, ::-1] # BGR => RGB
+        except IOError:
+            img = np.array(PIL.Image.open(io.BytesIO(value)))
+        return img
+    except:
+        print(sys.exc_info()[1])
+        return None
+
+def open_lmdb(lmdb_dir: str, *, max_images: Optional[int], decode_threads: int = 0, stats: Optional[ReadStats] = None):
     import lmdb  # pip install lmdb # pylint: disable=import-error
 
     with lmdb.open(lmdb_dir, readonly=True, lock=False).begin(write=False) as txn:
         max_idx = maybe_min(txn.stat()['entries'], max_images)
 
-    def iterate_images():
+    def read_raw():
+        # The transaction is opened by the thread that iterates it.
         with lmdb.open(lmdb_dir, readonly=True, lock=False).begin(write=False) as txn:
             for idx, (_key, value) in enumerate(txn.cursor()):
-                try:
-                    try:
-                        img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), 1)
-                        if img is None:
-                            raise IOError('cv2.imdecode failed')
-                        img = img[:, :, ::-1] # BGR => RGB
-                    except IOError:
-                        img = np.array(PIL.Image.open(io.BytesIO(value)))
-                    yield dict(img=img, label=None)
-                    if idx >= max_idx-1:
-                        break
-                except:
-                    print(sys.exc_info()[1])
+                if idx >= max_idx:
+                    break
+                yield bytes(value), dict(label=None)
 
-    return max_idx, iterate_images()
+    return max_idx, prefetch_decode(read_raw, decode_lmdb_image, decode_threads, stats or ReadStats())
 
 #----------------------------------------------------------------------------
 
@@ -196,30 +431,83 @@ def open_mnist(images_gz: str, *, max_images: Optional[int]):
 
 #----------------------------------------------------------------------------
 
+def open_npy(source: str, *, max_images: Optional[int]):
+    images = np.load(source, mmap_mode='r')
+    with open(source[:-len('.npy')] + '.json', 'r') as file:
+        labels = json.load(file)['labels']
+
+    max_idx = maybe_min(len(images), max_images)
+
+    def iterate_images():
+        for idx in range(max_idx):
+            img = np.array(images[idx])
+            yield dict(img=img[:, :, 0] if img.shape[2] == 1 else img, label=labels[idx] if labels is not None else None)
+
+    return max_idx, iterate_images()
+
+#----------------------------------------------------------------------------
+
+def is_pillow_simd() -> bool:
+    # Pillow-SIMD is versioned like Pillow with a '.postN' suffix.
+    return '.post' in PIL.__version__
+
+#----------------------------------------------------------------------------
+
+def make_resize(
+    resize_filter: str,
+    resize_backend: str = 'pil'
+) -> Callable[[np.ndarray, int, int, Optional[str]], np.ndarray]:
+    '''Return a function resize(img, width, height, mode) that resizes a HWC or HW uint8 array.
+
+    The opencv backend resizes the NumPy array in place of a PIL round trip and
+    maps 'box' to INTER_AREA.  'lanczos' maps to INTER_LANCZOS4 when enlarging
+    and to INTER_AREA when shrinking, because the fixed-size INTER_LANCZOS4 kernel
+    does not filter out the frequencies above the new resolution like PIL does.
+    The pillow-simd-if-present backend uses PIL only if it is Pillow-SIMD.'''
+
+    if resize_backend == 'pillow-simd-if-present':
+        resize_backend = 'pil' if is_pillow_simd() else 'opencv'
+
+    if resize_backend == 'opencv':
+        import cv2  # pip install opencv-python
+        enlarge_interpolation = { 'box': cv2.INTER_AREA, 'lanczos': cv2.INTER_LANCZOS4 }[resize_filter]
+        def opencv_resize(img, width, height, mode=None):
+            shrink = width <= img.shape[1] and height <= img.shape[0]
+            return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA if shrink else enlarge_interpolation)
+        return opencv_resize
+
+    assert resize_backend == 'pil', 'unknown resize backend'
+    resample = { 'box': PIL.Image.BOX, 'lanczos': PIL.Image.LANCZOS }[resize_filter]
+    def pil_resize(img, width, height, mode=None):
+        img = PIL.Image.fromarray(img, mode)
+        img = img.resize((width, height), resample)
+        return np.array(img)
+    return pil_resize
+
+#----------------------------------------------------------------------------
+
 def make_transform(
     transform: Optional[str],
     output_width: Optional[int],
     output_height: Optional[int],
-    resize_filter: str
-) -> Callable[[np.ndarray], Optional[np.ndarray]]:
-    resample = { 'box': PIL.Image.BOX, 'lanczos': PIL.Image.LANCZOS }[resize_filter]
+    resize_filter: str,
+    resize_backend: str = 'pil',
+    face_scale: float = 1.6
+) -> Callable[..., Optional[np.ndarray]]:
+    resize = make_resize(resize_filter, resize_backend)
     def scale(width, height, img):
         w = img.shape[1]
         h = img.shape[0]
         if width == w and height == h:
             return img
-        img = PIL.Image.fromarray(img)
         ww = width if width is not None else w
         hh = height if height is not None else h
-        img = img.resize((ww, hh), resample)
-        return np.array(img)
+        return resize(img, ww, hh)
 
     def center_crop(width, height, img):
         crop = np.min(img.shape[:2])
         img = img[(img.shape[0] - crop) // 2 : (img.shape[0] + crop) // 2, (img.shape[1] - crop) // 2 : (img.shape[1] + crop) // 2]
-        img = PIL.Image.fromarray(img, 'RGB')
-        img = img.resize((width, height), resample)
-        return np.array(img)
+        return resize(img, width, height, 'RGB')
 
     def center_crop_wide(width, height, img):
         ch = int(np.round(width * img.shape[0] / img.shape[1]))
@@ -227,14 +515,25 @@ def make_transform(
             return None
 
         img = img[(img.shape[0] - ch) // 2 : (img.shape[0] + ch) // 2]
-        img = PIL.Image.fromarray(img, 'RGB')
-        img = img.resize((width, height), resample)
-        img = np.array(img)
+        img = resize(img, width, height, 'RGB')
 
         canvas = np.zeros([width, width, 3], dtype=np.uint8)
         canvas[(width - height) // 2 : (width + height) // 2, :] = img
         return canvas
 
+    def face_align(width, height, img, face_box=None):
+        if face_box is None:
+            return center_crop(width, height, img)
+        # Square of face_scale times the face box around its center, shifted inside
+        # the image.  Slicing does not resample, so the only resampling is the resize.
+        h, w = img.shape[:2]
+        x, y, bw, bh = face_box[0] * w, face_box[1] * h, face_box[2] * w, face_box[3] * h
+        crop = int(min(max(bw, bh) * face_scale, w, h))
+        x0 = int(np.clip(np.round(x + (bw - crop) / 2), 0, w - crop))
+        y0 = int(np.clip(np.round(y + (bh - crop) / 2), 0, h - crop))
+        img = img[y0 : y0 + crop, x0 : x0 + crop]
+        return resize(img, width, height, 'RGB')
+
     if transform is None:
         return functools.partial(scale, output_width, output_height)
     if transform == 'center-crop':
@@ -245,23 +544,194 @@ def make_transform(
         if (output_width is None) or (output_height is None):
             error ('must specify --width and --height when using ' + transform + ' transform')
         return functools.partial(center_crop_wide, output_width, output_height)
+    if transform == 'face-align':
+        if (output_width is None) or (output_height is None):
+            error ('must specify --width and --height when using ' + transform + ' transform')
+        return functools.partial(face_align, output_width, output_height)
     assert False, 'unknown transform'
 
 #----------------------------------------------------------------------------
 
-def open_dataset(source, *, max_images: Optional[int]):
+def load_face_boxes(fname: str) -> dict:
+    '''Return { file name: (x, y, w, h) } from the JSON lines file written by
+    FaceIsolatorInterface, with the face box in fractions of the face image size.'''
+
+    face_boxes = {}
+    with open(fname, 'r') as file:
+        for line in file:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            face_boxes[record['name']] = tuple(v / record['size'] for v in record['face'])
+    return face_boxes
+
+#----------------------------------------------------------------------------
+
+def face_box_from_name(fname: str, face_ratio: float = 1.6) -> Optional[Tuple[float, float, float, float]]:
+    '''Return the face box of a FaceIsolatorInterface output name such as
+    'photo_face_0_size_412.jpg', in fractions of the face image size.
+
+    The name only records the size, so this assumes the face was centered and
+    the image was face_ratio times as wide as the face, which is not the case
+    for faces close to the border of the original image.'''
+
+    if re.search(r'_face_\d+_size_\d+\.\w+$', fname) is None:
+        return None
+    face = 1 / face_ratio
+    return ((1 - face) / 2, (1 - face) / 2, face, face)
+
+#----------------------------------------------------------------------------
+
+def attach_face_boxes(input_iter, face_boxes: dict):
+    '''Add the face box of every image to its dict, from face_boxes or from its name.'''
+
+    for image in input_iter:
+        if 'name' in image:
+            fname = os.path.basename(image['name'])
+            face_box = face_boxes.get(fname) or face_box_from_name(fname)
+            if face_box is not None:
+                image = dict(image, face_box=face_box)
+        yield image
+
+#----------------------------------------------------------------------------
+
+def encode_png(img: np.ndarray, png_encoder: str = 'pil') -> Union[memoryview, np.ndarray]:
+    '''Encode a HWC RGB or HW grayscale uint8 image as an uncompressed PNG.
+
+    The opencv encoder returns the buffer filled by cv2.imencode, which can be
+    written to the archive as is.  Both encoders decode to the same pixels.'''
+
+    if png_encoder == 'opencv':
+        import cv2  # pip install opencv-python
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        ok, image_bits = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+        if not ok:
+            raise IOError('cv2.imencode failed')
+        return image_bits
+
+    img = PIL.Image.fromarray(img, { 2: 'L', 3: 'RGB' }[img.ndim])
+    image_bits = io.BytesIO()
+    img.save(image_bits, format='png', compress_level=0, optimize=False)
+    return image_bits.getbuffer()
+
+#----------------------------------------------------------------------------
+
+def encode_image(
+    transform_image: Callable[..., Optional[np.ndarray]],
+    image: dict,
+    raw: bool = False,
+    png_encoder: str = 'pil',
+    dedupe: Optional[str] = None
+) -> Optional[Tuple[dict, Union[memoryview, np.ndarray], Optional[str], Optional[int]]]:
+    '''Decode, transform and PNG-encode one image.
+
+    Returns the image attributes, the PNG bytes (or the HWC uint8 array if raw is
+    set), the sha1 of the source file (None for sources that are not files) and
+    the dedupe_key() of the decoded image (None without dedupe), or None if the
+    transform dropped the image.'''
+
+    source_hash = None
+    if 'img' in image:
+        img = image['img']
+    else:
+        with open(image['path'], 'rb') as file:
+            data = file.read()
+        source_hash = hashlib.sha1(data).hexdigest()
+        img = np.array(PIL.Image.open(io.BytesIO(data)))
+    key = dedupe_key(dedupe, img, source_hash) if dedupe is not None else None
+
+    # Apply crop and resize.
+    if 'face_box' in image:
+        img = transform_image(img, face_box=image['face_box'])
+    else:
+        img = transform_image(img)
+
+    # Transform may drop images.
+    if img is None:
+        return None
+
+    channels = img.shape[2] if img.ndim == 3 else 1
+    image_attrs = {
+        'width': img.shape[1],
+        'height': img.shape[0],
+        'channels': channels
+    }
+
+    if raw:
+        return image_attrs, img.reshape(img.shape[0], img.shape[1], channels), source_hash, key
+
+    # Save the image as an uncompressed PNG.
+    return image_attrs, encode_png(img.reshape(img.shape[:2]) if channels == 1 else img, png_encoder), source_hash, key
+
+#----------------------------------------------------------------------------
+
+_worker_transform_image = None
+_worker_raw = False
+_worker_png_encoder = 'pil'
+_worker_dedupe = None
+
+def init_encode_worker(raw: bool, png_encoder: str, dedupe: Optional[str], *transform_args):
+    global _worker_transform_image, _worker_raw, _worker_png_encoder, _worker_dedupe
+    PIL.Image.init() # type: ignore
+    _worker_transform_image = make_transform(*transform_args)
+    _worker_raw = raw
+    _worker_png_encoder = png_encoder
+    _worker_dedupe = dedupe
+
+def encode_image_in_worker(image: dict) -> Optional[Tuple[dict, Union[bytes, np.ndarray], Optional[str], Optional[int]]]:
+    result = encode_image(_worker_transform_image, image, _worker_raw, _worker_png_encoder, _worker_dedupe)
+    if result is None or _worker_raw:
+        return result
+    return result[0], bytes(result[1]), result[2], result[3]
+
+def encode_images(input_iter, transform_args: tuple, workers: int, raw: bool = False, png_encoder: str = 'pil', dedupe: Optional[str] = None):
+    '''Yield (image, encode_image() result) in input order.
+
+    With more than one worker, decode, transform and encode run in a process pool
+    while the results are still yielded in input order, so the archive names and
+    contents are the same as in a serial run.'''
+
+    if workers <= 1:
+        transform_image = make_transform(*transform_args)
+        for image in input_iter:
+            yield image, encode_image(transform_image, image, raw, png_encoder, dedupe)
+        return
+
+    max_pending = workers * 4
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_encode_worker, initargs=(raw, png_encoder, dedupe, *transform_args)) as executor:
+        pending = collections.deque()
+        for image in input_iter:
+            pending.append((image, executor.submit(encode_image_in_worker, image)))
+            if len(pending) >= max_pending:
+                image, future = pending.popleft()
+                yield image, future.result()
+        while pending:
+            image, future = pending.popleft()
+            yield image, future.result()
+
+#----------------------------------------------------------------------------
+
+def is_image_folder(source: str) -> bool:
+    return os.path.isdir(source) and not source.rstrip('/').endswith('_lmdb')
+
+#----------------------------------------------------------------------------
+
+def open_dataset(source, *, max_images: Optional[int], source_index: Optional[str] = None, decode_threads: int = 0, stats: Optional[ReadStats] = None):
     if os.path.isdir(source):
         if source.rstrip('/').endswith('_lmdb'):
-            return open_lmdb(source, max_images=max_images)
+            return open_lmdb(source, max_images=max_images, decode_threads=decode_threads, stats=stats)
         else:
-            return open_image_folder(source, max_images=max_images)
+            return open_image_folder(source, max_images=max_images, index_fname=source_index)
     elif os.path.isfile(source):
         if os.path.basename(source) == 'cifar-10-python.tar.gz':
             return open_cifar10(source, max_images=max_images)
         elif os.path.basename(source) == 'train-images-idx3-ubyte.gz':
             return open_mnist(source, max_images=max_images)
         elif file_ext(source) == 'zip':
-            return open_image_zip(source, max_images=max_images)
+            return open_image_zip(source, max_images=max_images, decode_threads=decode_threads, stats=stats)
+        elif file_ext(source) == 'npy':
+            return open_npy(source, max_images=max_images)
         else:
             assert False, 'unknown archive type'
     else:
@@ -269,16 +739,120 @@ def open_dataset(source, *, max_images: Optional[int]):
 
 #----------------------------------------------------------------------------
 
-def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None], Callable[[], None]]:
+def open_existing_dest(dest: str) -> Tuple[dict, int, Optional[dict], Optional[list]]:
+    '''Return the metadata of an existing output dataset, the next free image index,
+    the attributes of its images (None if it has no images) and its integrity
+    index (None if it was written without one).'''
+
+    if file_ext(dest) == 'zip':
+        with zipfile.ZipFile(dest, mode='r') as z:
+            archive_fnames = z.namelist()
+            metadata = json.loads(z.read('dataset.json'))
+            index = json.loads(z.read('dataset_index.json'))['images'] if 'dataset_index.json' in archive_fnames else None
+            image_fnames = [f for f in archive_fnames if is_image_ext(f)]
+            first_image = PIL.Image.open(io.BytesIO(z.read(image_fnames[0]))) if image_fnames else None
+    else:
+        with open(os.path.join(dest, 'dataset.json'), 'r') as file:
+            metadata = json.load(file)
+        index = None
+        if os.path.isfile(os.path.join(dest, 'dataset_index.json')):
+            with open(os.path.join(dest, 'dataset_index.json'), 'r') as file:
+                index = json.load(file)['images']
+        image_fnames = [os.path.relpath(f, dest).replace('\\', '/') for f in Path(dest).rglob('*') if is_image_ext(f)]
+        first_image = PIL.Image.open(os.path.join(dest, image_fnames[0])) if image_fnames else None
+
+    indices = [int(m.group(1)) for m in (re.search(r'img(\d+)\.png$', f) for f in image_fnames) if m]
+    next_idx = max(indices) + 1 if indices else 0
+
+    dataset_attrs = None
+    if first_image is not None:
+        dataset_attrs = {
+            'width': first_image.width,
+            'height': first_image.height,
+            'channels': { 'L': 1, 'RGB': 3 }[first_image.mode]
+        }
+    return metadata, next_idx, dataset_attrs, index
+
+#----------------------------------------------------------------------------
+
+def backup_zip_tail(dest: str):
+    '''Save the last entry and the central directory of the zip archive dest to
+    dest + '.append-backup', so that restore_zip_tail() can undo an append.  Only
+    the tail of the archive is copied, the images before it are not touched by an
+    append.'''
+
+    with zipfile.ZipFile(dest, mode='r') as z:
+        offset = max((info.header_offset for info in z.infolist()), default=0)
+    with open(dest, 'rb') as file:
+        file.seek(offset)
+        tail = file.read()
+    backup_fname = dest + '.append-backup'
+    tmp_fname = f'{backup_fname}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as file:
+        file.write(offset.to_bytes(8, 'big') + tail)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_fname, backup_fname)
+
+def restore_zip_tail(dest: str) -> bool:
+    '''Cut dest back to the state saved by backup_zip_tail() and remove the backup.
+    Return False if there is no backup.'''
+
+    backup_fname = dest + '.append-backup'
+    if not os.path.isfile(backup_fname):
+        return False
+    with open(backup_fname, 'rb') as file:
+        offset = int.from_bytes(file.read(8), 'big')
+        tail = file.read()
+    with open(dest, 'r+b') as file:
+        file.truncate(offset)
+        file.seek(offset)
+        file.write(tail)
+        file.flush()
+        os.fsync(file.fileno())
+    os.remove(backup_fname)
+    return True
+
+#----------------------------------------------------------------------------
+
+def open_dest(dest: str, append: bool = False) -> Tuple[str, Callable[[str, Union[bytes, str]], Optional[int]], Callable[[], None], Callable[[], None]]:
+    '''Return the archive root directory, save_bytes(fname, data), close() and abort() of an
+    output dataset.  abort() undoes a zip --append after a failure.'''
+
     dest_ext = file_ext(dest)
 
     if dest_ext == 'zip':
         if os.path.dirname(dest) != '':
             os.makedirs(os.path.dirname(dest), exist_ok=True)
-        zf = zipfile.ZipFile(file=dest, mode='w', compression=zipfile.ZIP_STORED)
-        def zip_write_bytes(fname: str, data: Union[bytes, str]):
-            zf.writestr(fname, data)
-        return '', zip_write_bytes, zf.close
+        if not append:
+            zf = zipfile.ZipFile(file=dest, mode='w', compression=zipfile.ZIP_STORED)
+            def zip_write_bytes(fname: str, data: Union[bytes, str]) -> int:
+                zf.writestr(fname, data)
+                return zf.filelist[-1].header_offset
+            return '', zip_write_bytes, zf.close, lambda: None
+
+        # Append in place.  The new images overwrite the old central directory,
+        # which is saved first so that a failed or killed run can be undone.  The
+        # new dataset.json and dataset_index.json follow the new images, readers
+        # take the last entry of a name.
+        backup_zip_tail(dest)
+        zf = zipfile.ZipFile(file=dest, mode='a', compression=zipfile.ZIP_STORED)
+        def zip_append_bytes(fname: str, data: Union[bytes, str]) -> int:
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+                zf.writestr(fname, data)
+            return zf.filelist[-1].header_offset
+        def zip_append_close():
+            zf.close()
+            with open(dest, 'rb') as file:
+                os.fsync(file.fileno())
+            os.remove(dest + '.append-backup')
+        def zip_append_abort():
+            try:
+                zf.close()
+            finally:
+                restore_zip_tail(dest)
+        return '', zip_append_bytes, zip_append_close, zip_append_abort
     else:
         # If the output folder already exists, check that is is
         # empty.
@@ -287,17 +861,75 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
         # necessary as folder_write_bytes() also mkdirs, but it's better
         # to give an error message earlier in case the dest folder
         # somehow cannot be created.
-        if os.path.isdir(dest) and len(os.listdir(dest)) != 0:
+        if not append and os.path.isdir(dest) and len(os.listdir(dest)) != 0:
             error('--dest folder must be empty')
         os.makedirs(dest, exist_ok=True)
 
-        def folder_write_bytes(fname: str, data: Union[bytes, str]):
+        def folder_write_bytes(fname: str, data: Union[bytes, str]) -> None:
             os.makedirs(os.path.dirname(fname), exist_ok=True)
             with open(fname, 'wb') as fout:
                 if isinstance(data, str):
                     data = data.encode('utf8')
                 fout.write(data)
-        return dest, folder_write_bytes, lambda: None
+        return dest, folder_write_bytes, lambda: None, lambda: None
+
+#----------------------------------------------------------------------------
+
+def truncate_npy(fname: str, num_rows: int):
+    '''Keep only the first num_rows rows of a C-ordered .npy file in place, by
+    rewriting the shape in its header and truncating the data.'''
+
+    with open(fname, 'r+b') as file:
+        version = np.lib.format.read_magic(file)
+        prefix_len = file.tell() + (2 if version == (1, 0) else 4)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        assert not fortran_order and num_rows <= shape[0]
+        data_offset = file.tell()
+
+        # The new shape is never longer, so the padded header keeps its size and the data does not move.
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (num_rows, *shape[1:])})
+        header = header.encode('latin1').ljust(data_offset - prefix_len - 1) + b'\n'
+        assert prefix_len + len(header) == data_offset
+        file.seek(prefix_len)
+        file.write(header)
+        file.truncate(data_offset + num_rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+#----------------------------------------------------------------------------
+
+def open_npy_dest(dest: str, max_images: int) -> Tuple[Callable[[np.ndarray], None], Callable[[dict], None]]:
+    '''Open a raw output dataset: a single uint8 NHWC array memory-mapped in dest,
+    and a JSON sidecar with the labels and image attributes.'''
+
+    if os.path.dirname(dest) != '':
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp_fname = dest[:-len('.npy')] + '.tmp.npy'
+    state = dict(images=None, count=0)
+
+    def npy_write_image(img: np.ndarray):
+        if state['images'] is None:
+            state['images'] = np.lib.format.open_memmap(temp_fname, mode='w+', dtype=np.uint8, shape=(max_images, *img.shape))
+        state['images'][state['count']] = img
+        state['count'] += 1
+
+    def npy_close(metadata: dict):
+        images, count = state['images'], state['count']
+        if images is None:
+            images = np.lib.format.open_memmap(temp_fname, mode='w+', dtype=np.uint8, shape=(0, 0, 0, 0))
+        images.flush()
+        num_rows = len(images)
+        del images
+        state['images'] = None
+        # Shrink the array if the transform or --dedupe dropped images.
+        if count != num_rows:
+            truncate_npy(temp_fname, count)
+        os.replace(temp_fname, dest)
+        with open(dest[:-len('.npy')] + '.json', 'w') as file:
+            json.dump(metadata, file)
+
+    return npy_write_image, npy_close
 
 #----------------------------------------------------------------------------
 
@@ -305,20 +937,38 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
 @click.pass_context
 @click.option('--source', help='Directory or archive name for input dataset', required=True, metavar='PATH')
 @click.option('--dest', help='Output directory or archive name for output dataset', required=True, metavar='PATH')
+@click.option('--source-index', help='File that caches the listing of an image folder --source', metavar='PATH')
 @click.option('--max-images', help='Output only up to `max-images` images', type=int, default=None)
 @click.option('--resize-filter', help='Filter to use when resizing images for output resolution', type=click.Choice(['box', 'lanczos']), default='lanczos', show_default=True)
-@click.option('--transform', help='Input crop/resize mode', type=click.Choice(['center-crop', 'center-crop-wide']))
+@click.option('--resize-backend', help='Library used to resize images', type=click.Choice(['pil', 'opencv', 'pillow-simd-if-present']), default='pil', show_default=True)
+@click.option('--transform', help='Input crop/resize mode', type=click.Choice(['center-crop', 'center-crop-wide', 'face-align']))
+@click.option('--face-boxes', 'face_boxes_fname', help='Face boxes written by FaceIsolatorInterface for --transform=face-align', metavar='PATH')
+@click.option('--face-scale', help='Output size relative to the face box for --transform=face-align', type=float, default=1.6, show_default=True)
 @click.option('--width', help='Output width', type=int)
 @click.option('--height', help='Output height', type=int)
+@click.option('--decode-threads', help='Threads that decode images of a zip or LMDB --source ahead of conversion', type=int, default=4, show_default=True)
+@click.option('--png-encoder', help='Library used to encode the uncompressed PNGs', type=click.Choice(['pil', 'opencv']), default='pil', show_default=True)
+@click.option('--workers', help='Number of processes that decode, transform and encode images', type=int, default=1, show_default=True)
+@click.option('--append', help='Only add the source images that are not yet in --dest', is_flag=True)
+@click.option('--dedupe', help='Skip images that duplicate an earlier one', type=click.Choice(['exact', 'perceptual']))
 def convert_dataset(
     ctx: click.Context,
     source: str,
     dest: str,
+    source_index: Optional[str],
     max_images: Optional[int],
     transform: Optional[str],
+    face_boxes_fname: Optional[str],
+    face_scale: float,
     resize_filter: str,
+    resize_backend: str,
     width: Optional[int],
-    height: Optional[int]
+    height: Optional[int],
+    decode_threads: int,
+    png_encoder: str,
+    workers: int,
+    append: bool,
+    dedupe: Optional[str]
 ):
     """Convert an image dataset into a dataset archive usable with StyleGAN2 ADA PyTorch.
 
@@ -330,12 +980,14 @@ def convert_dataset(
     --source train-images-idx3-ubyte.gz Load MNIST dataset
     --source path/                      Recursively load all images from path/
     --source dataset.zip                Recursively load all images from dataset.zip
+    --source dataset.npy                Load raw images from dataset.npy
 
     Specifying the output format and path:
 
     \b
     --dest /path/to/dir                 Save output files under /path/to/dir
     --dest /path/to/dataset.zip         Save output files into /path/to/dataset.zip
+    --dest /path/to/dataset.npy         Save raw images into /path/to/dataset.npy
 
     The output dataset format can be either an image folder or an uncompressed zip archive.
     Zip archives makes it easier to move datasets around file servers and clusters, and may
@@ -343,6 +995,16 @@ def convert_dataset(
 
     Images within the dataset archive will be stored as uncompressed PNG.
     Uncompresed PNGs can be efficiently decoded in the training loop.
+    Use --png-encoder=opencv to encode them with cv2.imencode, whose output
+    buffer is written to the archive without an intermediate copy.  The files
+    differ from the PIL ones but decode to the same pixels, which
+    dataset_benchmark.py encode checks.
+
+    A .npy output stores all images in one uint8 array of shape [N, H, W, C] that
+    can be opened with np.load(mmap_mode='r') and sliced into batches without any
+    decoding.  Its labels and image attributes are stored in a JSON file with the
+    same name, e.g. /path/to/dataset.json.  Use dataset_benchmark.py read to
+    compare its read speed with a zip archive.
 
     Class labels are stored in a file called 'dataset.json' that is stored at the
     dataset root folder.  This file has the following structure:
@@ -377,6 +1039,58 @@ def convert_dataset(
     \b
     python dataset_tool.py --source LSUN/raw/cat_lmdb --dest /tmp/lsun_cat \\
         --transform=center-crop-wide --width 512 --height=384
+
+    Use --transform=face-align for the face images of FaceIsolatorInterface.  The
+    output is a square of --face-scale times the face box around the face,
+    cropped and resized in one resampling step.  The face box is read from the
+    --face-boxes file that FaceIsolatorInterface writes with face_box_path, or
+    guessed from the '_face_<i>_size_<size>' image name, which assumes that the
+    face is centered.  Images without a face box are center-cropped.
+
+    \b
+    python dataset_tool.py --source Classified_Image/Asian_face_dataset --dest /tmp/faces.zip \\
+        --transform=face-align --face-boxes Crop_Image/face_boxes.jsonl --width 256 --height=256
+
+    Use --resize-backend=opencv to resize the NumPy arrays with OpenCV instead of
+    converting every image to and from PIL.  Use dataset_benchmark.py resize to
+    compare its quality and speed with PIL.
+
+    Image folders are listed lazily, directory by directory, so conversion starts
+    right away.  Use --source-index to persist the listing: on later runs only
+    the directories whose modification time changed are listed again, and the
+    number of images is known up front.
+
+    Images of a zip or LMDB --source are read sequentially by one thread and
+    decoded ahead of the conversion by --decode-threads threads.  The read and
+    decode rates are printed at the end.
+
+    Use --workers to decode, transform and encode images in several processes.
+    The output is the same as with a single process.
+
+    For image folder sources, 'dataset.json' also maps every source path to its
+    archive name, the sha1 of the source file, its size and its modification
+    time.  With --append, an existing --dest is updated: only sources
+    that are new or whose content changed are converted and added after the
+    existing images.  The previous image of a changed source is kept.  Sources
+    with a new size or modification time but the same sha1 are not converted,
+    only their recorded size and time are updated.  A zip --dest is appended to
+    in place; its central directory is saved to DEST.append-backup first, so a
+    failed run is undone at once and a killed run by the next --append.
+
+    Use --dedupe to skip images that duplicate an earlier image.  'exact' compares
+    the sha1 of source files (or the decoded pixels for other sources) and also
+    skips copies of the images already in an --append --dest.  'perceptual'
+    compares a 64-bit difference hash of the decoded image, which usually also
+    catches resized and re-encoded copies.  Skipped sources are recorded in
+    'dataset.json' without an archive name, and the number of removed images is
+    printed.
+
+    Zip and folder outputs also get a 'dataset_index.json' next to 'dataset.json'
+    that lists the archive name, zip header offset, size, CRC-32, width, height
+    and channels of every image.  Check a dataset against it with:
+
+    \b
+    python dataset_tool.py validate --dataset /path/to/dataset.zip [--deep]
     """
 
     PIL.Image.init() # type: ignore
@@ -384,61 +1098,310 @@ def convert_dataset(
     if dest == '':
         ctx.fail('--dest output filename or directory must not be an empty string')
 
-    num_files, input_iter = open_dataset(source, max_images=max_images)
-    archive_root_dir, save_bytes, close_dest = open_dest(dest)
-
-    transform_image = make_transform(transform, width, height, resize_filter)
+    read_stats = ReadStats()
+    num_files, input_iter = open_dataset(source, max_images=max_images, source_index=source_index, decode_threads=decode_threads, stats=read_stats)
 
     dataset_attrs = None
-
+    start_idx = 0
     labels = []
-    for idx, image in tqdm(enumerate(input_iter), total=num_files):
-        idx_str = f'{idx:08d}'
-        archive_fname = f'{idx_str[:5]}/img{idx_str}.png'
-
-        # Apply crop and resize.
-        img = transform_image(image['img'])
-
-        # Transform may drop images.
-        if img is None:
-            continue
-
-        # Error check to require uniform image attributes across
-        # the whole dataset.
-        channels = img.shape[2] if img.ndim == 3 else 1
-        cur_image_attrs = {
-            'width': img.shape[1],
-            'height': img.shape[0],
-            'channels': channels
+    sources = {}
+    index: Optional[list] = []
+    num_touched = 0
+    if append and os.path.exists(dest):
+        if not is_image_folder(source):
+            error('--append requires an image folder --source')
+        if file_ext(dest) == 'zip' and restore_zip_tail(dest):
+            print(f'Undid the interrupted --append of a previous run to {dest}')
+        metadata, start_idx, dataset_attrs, index = open_existing_dest(dest)
+        if index is None:
+            print(f'{dest} has no dataset_index.json, the appended dataset will not have one either')
+        sources = metadata.get('sources') or {}
+        if metadata['labels'] is not None:
+            labels = metadata['labels']
+        else:
+            # The existing images have no labels, so neither has the result.
+            labels = [None]
+
+        def iterate_new_images(input_iter):
+            nonlocal num_touched
+            for image in input_iter:
+                known = sources.get(image['name'])
+                if known is not None:
+                    stat = os.stat(image['path'])
+                    if (known[2], known[3]) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    # Copies that do not keep the modification time change only the stat.
+                    with open(image['path'], 'rb') as file:
+                        if hashlib.sha1(file.read()).hexdigest() == known[1]:
+                            known[2], known[3] = stat.st_size, stat.st_mtime_ns
+                            num_touched += 1
+                            continue
+                yield image
+        input_iter = iterate_new_images(input_iter)
+    else:
+        append = False
+    raw = file_ext(dest) == 'npy'
+    if raw:
+        if append:
+            error('--append is not supported for .npy output')
+        if num_files is None:
+            # The array size is needed up front.
+            input_iter = list(input_iter)
+            num_files = len(input_iter)
+        save_array, close_npy = open_npy_dest(dest, num_files)
+        abort_dest = lambda: None
+    else:
+        archive_root_dir, save_bytes, close_dest, abort_dest = open_dest(dest, append)
+
+    try:
+        if transform == 'face-align':
+            input_iter = attach_face_boxes(input_iter, load_face_boxes(face_boxes_fname) if face_boxes_fname is not None else {})
+
+        transform_args = (transform, width, height, resize_filter, resize_backend, face_scale)
+        # Check the transform arguments before starting any worker.
+        make_transform(*transform_args)
+
+        seen_keys = UInt64Set()
+        if dedupe == 'exact':
+            for known in sources.values():
+                seen_keys.add(int(known[1][:16], 16))
+        num_duplicates = 0
+
+        num_changed = 0
+        for idx, (image, encoded) in tqdm(enumerate(encode_images(input_iter, transform_args, workers, raw, png_encoder, dedupe), start_idx), total=num_files):
+            idx_str = f'{idx:08d}'
+            archive_fname = f'{idx_str[:5]}/img{idx_str}.png'
+
+            # Transform may drop images.
+            if encoded is None:
+                continue
+
+            # Error check to require uniform image attributes across
+            # the whole dataset.
+            cur_image_attrs, image_bits, source_hash, key = encoded
+            if key is not None and not seen_keys.add(key):
+                num_duplicates += 1
+                if source_hash is not None:
+                    # Remember the source so that --append does not convert it again.
+                    stat = os.stat(image['path'])
+                    sources[image['name']] = [None, source_hash, stat.st_size, stat.st_mtime_ns]
+                continue
+
+            if dataset_attrs is None:
+                dataset_attrs = cur_image_attrs
+                width = dataset_attrs['width']
+                height = dataset_attrs['height']
+                if width != height:
+                    error(f'Image dimensions after scale and crop are required to be square.  Got {width}x{height}')
+                if dataset_attrs['channels'] not in [1, 3]:
+                    error('Input images must be stored as RGB or grayscale')
+                if width != 2 ** int(np.floor(np.log2(width))):
+                    error('Image width/height after scale and crop are required to be power-of-two')
+            elif dataset_attrs != cur_image_attrs:
+                err = [f'  dataset {k}/cur image {k}: {dataset_attrs[k]}/{cur_image_attrs[k]}' for k in dataset_attrs.keys()]
+                error(f'Image {archive_fname} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
+
+            if raw:
+                save_array(image_bits)
+            else:
+                offset = save_bytes(os.path.join(archive_root_dir, archive_fname), image_bits)
+                if index is not None:
+                    index.append([archive_fname, offset, memoryview(image_bits).nbytes, zlib.crc32(image_bits),
+                                  dataset_attrs['width'], dataset_attrs['height'], dataset_attrs['channels']])
+            labels.append([archive_fname, image['label']] if image['label'] is not None else None)
+
+            if source_hash is not None:
+                known = sources.get(image['name'])
+                if known is not None:
+                    num_changed += known[1] != source_hash
+                stat = os.stat(image['path'])
+                sources[image['name']] = [archive_fname, source_hash, stat.st_size, stat.st_mtime_ns]
+
+        if read_stats.decoded != 0:
+            print(f'Source {read_stats.summary()}')
+
+        if dedupe is not None:
+            print(f'--dedupe={dedupe} removed {num_duplicates} duplicate images')
+
+        if num_touched != 0:
+            print(f'{num_touched} source images with a new size or modification time but the same content were skipped')
+
+        if num_changed != 0:
+            print(f'{num_changed} changed source images were added again, their previous images are still in the dataset')
+
+        metadata = {
+            'labels': labels if all(x is not None for x in labels) else None
         }
-        if dataset_attrs is None:
-            dataset_attrs = cur_image_attrs
-            width = dataset_attrs['width']
-            height = dataset_attrs['height']
-            if width != height:
-                error(f'Image dimensions after scale and crop are required to be square.  Got {width}x{height}')
-            if dataset_attrs['channels'] not in [1, 3]:
-                error('Input images must be stored as RGB or grayscale')
-            if width != 2 ** int(np.floor(np.log2(width))):
-                error('Image width/height after scale and crop are required to be power-of-two')
-        elif dataset_attrs != cur_image_attrs:
-            err = [f'  dataset {k}/cur image {k}: {dataset_attrs[k]}/{cur_image_attrs[k]}' for k in dataset_attrs.keys()]
-            error(f'Image {archive_fname} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
-
-        # Save the image as an uncompressed PNG.
-        img = PIL.Image.fromarray(img, { 1: 'L', 3: 'RGB' }[channels])
-        image_bits = io.BytesIO()
-        img.save(image_bits, format='png', compress_level=0, optimize=False)
-        save_bytes(os.path.join(archive_root_dir, archive_fname), image_bits.getbuffer())
-        labels.append([archive_fname, image['label']] if image['label'] is not None else None)
-
-    metadata = {
-        'labels': labels if all(x is not None for x in labels) else None
-    }
-    save_bytes(os.path.join(archive_root_dir, 'dataset.json'), json.dumps(metadata))
-    close_dest()
+        if raw:
+            metadata = {
+                'labels': [x[1] for x in labels] if metadata['labels'] is not None else None,
+                'num_images': len(labels),
+                **(dataset_attrs or {})
+            }
+            close_npy(metadata)
+            return
+
+        if sources:
+            metadata['sources'] = sources
+        if index is not None:
+            save_bytes(os.path.join(archive_root_dir, 'dataset_index.json'), json.dumps({'images': index}))
+        save_bytes(os.path.join(archive_root_dir, 'dataset.json'), json.dumps(metadata))
+        close_dest()
+    except BaseException:
+        abort_dest()
+        raise
+
+#----------------------------------------------------------------------------
+
+def read_png_shape(data: bytes) -> Optional[Tuple[int, int, int]]:
+    '''Return (width, height, channels) from the IHDR chunk of an 8-bit PNG, None if data is not one.'''
+
+    if len(data) < 26 or data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        return None
+    width, height = int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+    bit_depth, color_type = data[24], data[25]
+    channels = { 0: 1, 2: 3, 4: 2, 6: 4 }.get(color_type)
+    if bit_depth != 8 or channels is None:
+        return None
+    return width, height, channels
+
+#----------------------------------------------------------------------------
+
+def validate_index_entries(dataset: str, entries: List[list], deep: bool) -> List[str]:
+    '''Check the images listed in entries of dataset_index.json against their bytes in dataset.
+
+    Zip entries are read through their own file handle at their local header
+    offset, so several calls can run in parallel.  Return the found problems.'''
+
+    problems = []
+    is_zip = file_ext(dataset) == 'zip'
+    with open(dataset, 'rb') if is_zip else contextlib.nullcontext() as file:
+        for archive_fname, offset, size, crc, width, height, channels in entries:
+            try:
+                if is_zip:
+                    file.seek(offset)
+                    header = file.read(30)
+                    if len(header) != 30 or header[:4] != b'PK\x03\x04':
+                        problems.append(f'{archive_fname}: no zip entry at offset {offset}')
+                        continue
+                    compression = int.from_bytes(header[8:10], 'little')
+                    name_len, extra_len = int.from_bytes(header[26:28], 'little'), int.from_bytes(header[28:30], 'little')
+                    if file.read(name_len).decode('utf8') != archive_fname or compression != zipfile.ZIP_STORED:
+                        problems.append(f'{archive_fname}: zip entry at offset {offset} is a different or compressed file')
+                        continue
+                    file.seek(extra_len, os.SEEK_CUR)
+                    data = file.read(size)
+                else:
+                    with open(os.path.join(dataset, archive_fname), 'rb') as image_file:
+                        data = image_file.read()
+            except OSError as e:
+                problems.append(f'{archive_fname}: {e}')
+                continue
+
+            if len(data) != size:
+                problems.append(f'{archive_fname}: {len(data)} bytes, expected {size}')
+                continue
+            if zlib.crc32(data) != crc:
+                problems.append(f'{archive_fname}: CRC-32 mismatch')
+                continue
+            if read_png_shape(data) != (width, height, channels):
+                problems.append(f'{archive_fname}: PNG header {read_png_shape(data)} does not match {(width, height, channels)}')
+                continue
+            if deep:
+                try:
+                    img = np.array(PIL.Image.open(io.BytesIO(data)))
+                except Exception as e: # pylint: disable=broad-except
+                    problems.append(f'{archive_fname}: cannot be decoded: {e}')
+                    continue
+                if img.shape[:2] != (height, width) or (img.shape[2] if img.ndim == 3 else 1) != channels:
+                    problems.append(f'{archive_fname}: decoded shape {img.shape} does not match {(width, height, channels)}')
+    return problems
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--dataset', help='Zip archive or directory written by this tool', required=True, metavar='PATH')
+@click.option('--deep', help='Also decode every image, in a process pool', is_flag=True)
+@click.option('--workers', help='Number of threads, or processes with --deep', type=int, default=os.cpu_count(), show_default=True)
+@click.option('--chunk-size', help='Images checked per task', type=int, default=256, show_default=True)
+def validate_dataset(
+    dataset: str,
+    deep: bool,
+    workers: int,
+    chunk_size: int
+):
+    """Check a dataset against the 'dataset_index.json' written by the conversion.
+
+    The zip central directory and the labels of 'dataset.json' are compared
+    with the index, and the bytes of every image are checked for their size,
+    CRC-32 and PNG header in --workers threads without decoding them.  With
+    --deep every image is also decoded, in --workers processes.
+
+    Exits with status 1 and lists the problems if any is found, e.g. for an
+    archive left behind by a conversion that crashed.
+
+    \b
+    python dataset_tool.py validate --dataset /path/to/dataset.zip
+    python dataset_tool.py validate --dataset /path/to/dataset.zip --deep
+    """
+
+    PIL.Image.init() # type: ignore
+
+    problems = []
+    if file_ext(dataset) == 'zip':
+        try:
+            with zipfile.ZipFile(dataset, mode='r') as z:
+                infos = { info.filename: info for info in z.infolist() }
+                metadata = json.loads(z.read('dataset.json'))
+                index = json.loads(z.read('dataset_index.json'))['images']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            error(f'Cannot read the metadata of {dataset}: {e}')
+    elif os.path.isdir(dataset):
+        infos = None
+        try:
+            with open(os.path.join(dataset, 'dataset.json'), 'r') as file:
+                metadata = json.load(file)
+            with open(os.path.join(dataset, 'dataset_index.json'), 'r') as file:
+                index = json.load(file)['images']
+        except (OSError, ValueError) as e:
+            error(f'Cannot read the metadata of {dataset}: {e}')
+    else:
+        error('--dataset must be a zip archive or a directory written by this tool')
+
+    # Cross-check the index with the zip central directory and the labels.
+    indexed_fnames = [entry[0] for entry in index]
+    if len(set(indexed_fnames)) != len(indexed_fnames):
+        problems.append('dataset_index.json lists some images more than once')
+    if infos is not None:
+        for archive_fname, offset, size, crc, *_ in index:
+            info = infos.get(archive_fname)
+            if info is None:
+                problems.append(f'{archive_fname}: missing from the archive')
+            elif (info.header_offset, info.file_size, info.CRC) != (offset, size, crc):
+                problems.append(f'{archive_fname}: central directory does not match the index')
+        unindexed = set(fname for fname in infos if is_image_ext(fname)) - set(indexed_fnames)
+        if unindexed:
+            problems.append(f'{len(unindexed)} images of the archive are not in the index, e.g. {min(unindexed)}')
+    if metadata.get('labels') is not None and [label[0] for label in metadata['labels']] != indexed_fnames:
+        problems.append('the labels of dataset.json do not list the same images as the index')
+    if len(set(tuple(entry[4:]) for entry in index)) > 1:
+        problems.append('the images do not all have the same width, height and channels')
+
+    chunks = [index[i:i + chunk_size] for i in range(0, len(index), chunk_size)]
+    executor_type = concurrent.futures.ProcessPoolExecutor if deep else concurrent.futures.ThreadPoolExecutor
+    with executor_type(max_workers=max(workers, 1)) as executor:
+        results = executor.map(validate_index_entries, [dataset] * len(chunks), chunks, [deep] * len(chunks))
+        for chunk_problems in tqdm(results, total=len(chunks), unit='chunk'):
+            problems += chunk_problems
+
+    if problems:
+        error(f'{len(problems)} problems found in {dataset}:\n' + '\n'.join(f'  {problem}' for problem in problems))
+    print(f'{dataset}: {len(index)} images OK')
 
 #----------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    convert_dataset() # pylint: disable=no-value-for-parameter
+    if sys.argv[1:2] == ['validate']:
+        validate_dataset(sys.argv[2:], prog_name=f'{sys.argv[0]} validate') # pylint: disable=no-value-for-parameter,unexpected-keyword-arg
+    else:
+        convert_dataset() # pylint: disable=no-value-for-parameter
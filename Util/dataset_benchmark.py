@@ -0,0 +1,157 @@
+"""Benchmarks for the dataset formats written by NVDIA_stylegan2_ada_dataset_tool.py."""
+
+import io
+import time
+import zipfile
+from pathlib import Path
+from typing import List, Optional
+
+import click
+import numpy as np
+import PIL.Image
+
+from NVDIA_stylegan2_ada_dataset_tool import encode_png, is_image_ext, is_pillow_simd, make_resize
+
+#----------------------------------------------------------------------------
+
+@click.group()
+def main():
+    """Benchmarks for the dataset tool.
+
+    \b
+    python dataset_benchmark.py read --zip dataset.zip --npy dataset.npy
+    python dataset_benchmark.py resize --source Classified_Image/Asian_face_dataset
+    python dataset_benchmark.py encode --source Classified_Image/Asian_face_dataset
+    """
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--zip', 'zip_path', help='Dataset archive of PNG images', metavar='PATH')
+@click.option('--npy', 'npy_path', help='Raw memory-mapped dataset', metavar='PATH')
+@click.option('--batch-size', help='Images per batch', type=int, default=64, show_default=True)
+@click.option('--max-images', help='Read only up to `max-images` images', type=int, default=None)
+def read(
+    zip_path: Optional[str],
+    npy_path: Optional[str],
+    batch_size: int,
+    max_images: Optional[int]
+):
+    """Compare read-back speed of a zip-PNG dataset and a raw .npy dataset.
+
+    Both readers produce the same NHWC uint8 batches a training loop would copy
+    to the device.  Run it on a cold cache for the disk-bound numbers.
+    """
+    PIL.Image.init() # type: ignore
+
+    if zip_path is not None:
+        with zipfile.ZipFile(zip_path, mode='r') as z:
+            fnames = sorted(f for f in z.namelist() if is_image_ext(f))[:max_images]
+            start = time.perf_counter()
+            for i in range(0, len(fnames), batch_size):
+                batch = []
+                for fname in fnames[i:i + batch_size]:
+                    with z.open(fname, 'r') as file:
+                        batch.append(np.array(PIL.Image.open(file)))
+                batch = np.stack(batch)
+            elapsed = time.perf_counter() - start
+        print(f'zip-PNG: {len(fnames)} images in {elapsed:.2f} s, {len(fnames) / elapsed:.1f} images/s')
+
+    if npy_path is not None:
+        images = np.load(npy_path, mmap_mode='r')[:max_images]
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            batch = np.array(images[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        print(f'npy    : {len(images)} images in {elapsed:.2f} s, {len(images) / elapsed:.1f} images/s')
+
+#----------------------------------------------------------------------------
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--source', help='Directory of RGB images to resize', required=True, metavar='PATH')
+@click.option('--num-images', help='Number of images to resize', type=int, default=64, show_default=True)
+@click.option('--resize-filter', help='Filter to use when resizing images', type=click.Choice(['box', 'lanczos']), default='lanczos', show_default=True)
+@click.option('--sizes', help='Comma separated output sizes', default='256,512,1024', show_default=True)
+def resize(
+    source: str,
+    num_images: int,
+    resize_filter: str,
+    sizes: str
+):
+    """Compare the resize backends of make_transform against PIL.
+
+    Reports images/s for every backend and output size, and the PSNR of each
+    backend's output against the PIL output.
+    """
+    PIL.Image.init() # type: ignore
+
+    fnames = sorted(str(f) for f in Path(source).rglob('*') if is_image_ext(f))[:num_images]
+    images: List[np.ndarray] = [np.array(PIL.Image.open(fname).convert('RGB')) for fname in fnames]
+    print(f'Loaded {len(images)} images, Pillow-SIMD {"found" if is_pillow_simd() else "not found"}')
+
+    backends = ['pil', 'opencv', 'pillow-simd-if-present']
+    for size in [int(x) for x in sizes.split(',')]:
+        reference = None
+        for backend in backends:
+            resize_image = make_resize(resize_filter, backend)
+            start = time.perf_counter()
+            outputs = [resize_image(img, size, size, 'RGB') for img in images]
+            elapsed = time.perf_counter() - start
+
+            if reference is None:
+                reference = outputs
+            quality = np.mean([psnr(a, b) for a, b in zip(outputs, reference)])
+            print(f'{size:5d} {backend:24s}: {len(images) / elapsed:8.1f} images/s, PSNR vs pil {quality:.2f} dB')
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--source', help='Directory of RGB images to encode', required=True, metavar='PATH')
+@click.option('--num-images', help='Number of images to encode', type=int, default=64, show_default=True)
+@click.option('--size', help='Resize the images to this size first (0 keeps the original size)', type=int, default=1024, show_default=True)
+def encode(
+    source: str,
+    num_images: int,
+    size: int
+):
+    """Compare the PNG encoders of the dataset tool.
+
+    Reports images/s and MB/s for every encoder, including the copy into a zip
+    entry, and checks that every PNG decodes to the original pixels.
+    """
+    PIL.Image.init() # type: ignore
+
+    fnames = sorted(str(f) for f in Path(source).rglob('*') if is_image_ext(f))[:num_images]
+    images = []
+    for fname in fnames:
+        img = PIL.Image.open(fname).convert('RGB')
+        if size != 0:
+            img = img.resize((size, size), PIL.Image.LANCZOS)
+        images.append(np.array(img))
+    print(f'Loaded {len(images)} images')
+
+    for png_encoder in ['pil', 'opencv']:
+        with zipfile.ZipFile(io.BytesIO(), mode='w', compression=zipfile.ZIP_STORED) as zf:
+            num_bytes = 0
+            start = time.perf_counter()
+            for idx, img in enumerate(images):
+                image_bits = encode_png(img, png_encoder)
+                zf.writestr(f'img{idx:08d}.png', image_bits)
+                num_bytes += len(image_bits)
+            elapsed = time.perf_counter() - start
+
+            identical = all(np.array_equal(np.array(PIL.Image.open(zf.open(f'img{idx:08d}.png'))), img) for idx, img in enumerate(images))
+        print(f'{png_encoder:6s}: {len(images) / elapsed:8.1f} images/s, {num_bytes / 2**20 / elapsed:8.1f} MB/s, pixels identical: {identical}')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
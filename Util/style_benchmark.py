@@ -0,0 +1,105 @@
+"""Benchmarks for the style utilities."""
+
+import time
+from typing import Optional
+
+import click
+import torch
+
+from style_generator import StandInGenerator, generator_options, load_generator, map_seeds, pick_device, prepare_generator, set_num_threads, synthesize
+from style_interpolation_video import count_seed_mapping_collisions, create_seed_mapping
+
+#----------------------------------------------------------------------------
+
+@click.group()
+def main():
+    """Benchmarks for the style utilities.
+
+    \b
+    python style_benchmark.py synthesis --device cpu --threads 8
+    python style_benchmark.py seed-mapping --grids 4x7,10x16,20x32
+    """
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--network', 'network_pkl', help='Network pickle filename, a small stand-in generator if not given')
+@click.option('--resolution', help='Output resolution of the stand-in generator', type=int, default=256, show_default=True)
+@click.option('--batch-size', help='Images per synthesis call', type=int, default=8, show_default=True)
+@click.option('--num-images', help='Number of images to synthesize per layout', type=int, default=64, show_default=True)
+@generator_options
+def synthesis(
+    network_pkl: Optional[str],
+    resolution: int,
+    batch_size: int,
+    num_images: int,
+    device: str,
+    threads: int,
+    interop_threads: int,
+    channels_last: bool
+):
+    """Measure synthesis throughput in images/s.
+
+    Runs the generator in the default layout and in channels-last layout
+    (the --channels-last option is ignored), after one warm-up batch each.
+    """
+    device = pick_device(device)
+    set_num_threads(threads, interop_threads)
+    print(f'Device {device}, {torch.get_num_threads()} threads')
+
+    for channels_last in [False, True]:
+        if network_pkl is None:
+            G = prepare_generator(StandInGenerator(resolution).to(device), channels_last)
+        else:
+            G = load_generator(network_pkl, device, channels_last)
+        ws = map_seeds(G, list(range(batch_size)), 1, device)
+
+        synthesize(G, ws)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(0, num_images, batch_size):
+            images = synthesize(G, ws)
+        images.cpu()
+        elapsed = time.perf_counter() - start
+
+        num_batches = (num_images + batch_size - 1) // batch_size
+        layout = 'channels-last' if channels_last else 'contiguous'
+        print(f'{G.img_resolution}x{G.img_resolution} {layout:13s}: {num_batches * batch_size / elapsed:8.2f} images/s')
+
+#----------------------------------------------------------------------------
+
+@main.command('seed-mapping')
+@click.option('--grids', help='Comma separated ROWSxCOLS grid sizes', default='4x7,10x16,20x32', show_default=True)
+@click.option('--image-per-cell', help='Number of image in a cell', type=int, default=5, show_default=True)
+@click.option('--seed-ratio', help='Number of seeds relative to the number of images of the grid', type=float, default=0.5, show_default=True)
+@click.option('--state', help='Random state', type=int, default=1, show_default=True)
+def seed_mapping(
+    grids: str,
+    image_per_cell: int,
+    seed_ratio: float,
+    state: int
+):
+    """Measure create_seed_mapping of style_interpolation_video.py over grid sizes.
+
+    The default --seed-ratio leaves too few seeds for create_unique_seed_mapping,
+    which is the case create_seed_mapping is used for.  Every mapping is checked
+    for collisions.
+    """
+    for grid in grids.split(','):
+        num_row, num_col = [int(x) for x in grid.split('x')]
+        seeds = list(range(1, max(int(num_row * num_col * image_per_cell * seed_ratio), image_per_cell) + 1))
+
+        start = time.perf_counter()
+        mapping = create_seed_mapping(num_row, num_col, image_per_cell, seeds, state)
+        elapsed = time.perf_counter() - start
+
+        result = 'no mapping' if mapping is None else f'{count_seed_mapping_collisions(mapping)} collisions'
+        print(f'{num_row:3d}x{num_col:<3d} {len(seeds):6d} seeds: {elapsed:8.3f} s, {result}')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
+
+#----------------------------------------------------------------------------
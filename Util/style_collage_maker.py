@@ -13,18 +13,16 @@
 
 import os
 import re
-from typing import List
+from typing import List, Optional
 
 import click
-import dnnlib
 import numpy as np
-import PIL.Image
-import torch
 
 import cv2
 import random
 
-import legacy
+from style_generator import WCache, generator_options, load_generator, map_seeds, pick_device, set_num_threads, synthesize_batches, w_cache_option
+from style_writers import PngStreamWriter
 
 #----------------------------------------------------------------------------
 
@@ -48,6 +46,9 @@ def num_range(s: str) -> List[int]:
 @click.option('--trunc', 'truncation_psi', type=float, help='Truncation psi', default=1, show_default=True)
 @click.option('--noise-mode', help='Noise mode', type=click.Choice(['const', 'random', 'none']), default='const', show_default=True)
 @click.option('--outdir', type=str, required=True)
+@click.option('--batch-size', type = int, help = 'Number of cells per synthesis call, lower it if it runs out of memory', default = 16, show_default = True)
+@w_cache_option
+@generator_options
 def generate_style_interpolation_video(
     network_pkl: str,
     seeds: List[int],
@@ -55,50 +56,68 @@ def generate_style_interpolation_video(
     num_col: int,
     truncation_psi: float,
     noise_mode: str,
-    outdir: str
+    outdir: str,
+    batch_size: int,
+    device: str,
+    threads: int,
+    interop_threads: int,
+    channels_last: bool,
+    w_cache_dir: Optional[str]
 ):
-    """Generate style collage of images using pretrained network pickle."""
+    """Generate style collage of images using pretrained network pickle.
 
-    print('Loading networks from "%s"...' % network_pkl)
-    device = torch.device('cuda')
-    with dnnlib.util.open_url(network_pkl) as f:
-        G = legacy.load_network_pkl(f)['G_ema'].to(device) # type: ignore
+    The first num_row * num_col distinct seeds fill the collage row by row, in the
+    given order.  The cells are synthesized in --batch-size batches and the PNG is
+    written one row of cells at a time, so even a 50 by 50 collage of 1024x1024
+    images only needs one row in memory.
+
+    The generator runs on the GPU if there is one and on the CPU otherwise, see --device.
+    """
+
+    device = pick_device(device)
+    set_num_threads(threads, interop_threads)
+    print('Loading networks from "%s" on %s...' % (network_pkl, device))
+    G = load_generator(network_pkl, device, channels_last)
 
     os.makedirs(outdir, exist_ok=True)
 
+    # Keep the order of the seeds, the first num_row * num_col fill the collage row by row
+    seeds = list(dict.fromkeys(seeds))
+    if len(seeds) < num_row * num_col:
+        print(f"Need {num_row * num_col} distinct seeds for a {num_row} by {num_col} collage, got {len(seeds)}")
+        return
+    seeds = seeds[:num_row * num_col]
+
     print('Generating W vectors ...')
-    seeds = list(set(seeds))
-    all_z = np.stack([np.random.RandomState(seed).randn(G.z_dim) for seed in seeds])
-    all_w = G.mapping(torch.from_numpy(all_z).to(device), None)
-    w_avg = G.mapping.w_avg
-    all_w = w_avg + (all_w - w_avg) * truncation_psi
-    w_dict = {seed: w for seed, w in zip(seeds, list(all_w))}
+    w_cache = WCache(w_cache_dir, network_pkl, truncation_psi) if w_cache_dir is not None else None
+    all_w = map_seeds(G, seeds, truncation_psi, device, w_cache)
 
     cell_width  = G.img_resolution
     cell_height = G.img_resolution
     collage_width  = cell_width  * num_col
     collage_height = cell_height * num_row
-    canvas = np.zeros((collage_height, collage_width, 3), np.uint8)
-
 
+    # Only one row of cells is in memory, it is appended to the PNG once it is complete.
+    file_name = f"{outdir}/Style GAN Collage {num_row} by {num_col}.png"
+    collage   = PngStreamWriter(file_name, collage_width, collage_height)
+    strip     = np.zeros((cell_height, collage_width, 3), np.uint8)
 
     print('Generating style collage images ...')
-    for row_index in range(num_row):
-        x = row_index * cell_height
-        for col_index in range(num_col):
-            seed  = seeds[row_index * num_col + col_index]
-            w     = w_dict[seed] 
-            image = G.synthesis(w[np.newaxis], noise_mode = noise_mode) 
-            image = (image.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-            image = image[0].cpu().numpy()
-
+    cell_index = 0
+    for images in synthesize_batches(G, all_w, batch_size, noise_mode):
+        for image in images.cpu().numpy():
+            col_index = cell_index % num_col
             y = col_index * cell_width
-            canvas[x:x + cell_height:, y:y + cell_width:, ::] = image
+            strip[::, y:y + cell_width:, ::] = image
 
+            cell_index += 1
+            if col_index == num_col - 1:
+                print(f"\rGenerating style collage row {cell_index // num_col}/{num_row} ...", end = '')
+                collage.write_rows(strip)
+
+    print()
     print('Saving collage ...')
-    os.makedirs(outdir, exist_ok = True)
-    file_name = f"{outdir}/Style GAN Collage {num_row} by {num_col}.png"
-    PIL.Image.fromarray(canvas, 'RGB').save(file_name)
+    collage.close()
 
 #----------------------------------------------------------------------------
 
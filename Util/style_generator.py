@@ -0,0 +1,277 @@
+"""Device selection, generator loading and synthesis shared by the style utilities.
+
+Copy this file next to style_interpolation.py, style_interpolation_video.py and
+style_collage_maker.py in the stylegan2-ada-pytorch repository, which provides
+dnnlib and legacy.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import time
+from typing import Dict, Iterator, List, Optional
+
+import click
+import numpy as np
+import torch
+
+#----------------------------------------------------------------------------
+
+def generator_options(fn):
+    '''Add the --device, --threads, --interop-threads and --channels-last options to a click command.'''
+
+    options = [
+        click.option('--device', help='Device to run the generator on', type=click.Choice(['auto', 'cuda', 'cpu']), default='auto', show_default=True),
+        click.option('--threads', help='Torch intra-op threads (0 keeps the torch default)', type=int, default=0, show_default=True),
+        click.option('--interop-threads', help='Torch inter-op threads (0 keeps the torch default)', type=int, default=0, show_default=True),
+        click.option('--channels-last', help='Run the synthesis network in channels-last memory format', is_flag=True),
+    ]
+    for option in reversed(options):
+        fn = option(fn)
+    return fn
+
+#----------------------------------------------------------------------------
+
+def pick_device(device: str = 'auto') -> torch.device:
+    '''Return the cuda device if device is 'auto' and one is available, the cpu otherwise.'''
+
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+#----------------------------------------------------------------------------
+
+def set_num_threads(threads: int = 0, interop_threads: int = 0):
+    '''Set the torch thread counts, 0 keeps the default.  Call it before running any network.'''
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+
+#----------------------------------------------------------------------------
+
+def prepare_generator(G: torch.nn.Module, channels_last: bool = False) -> torch.nn.Module:
+    G.eval().requires_grad_(False)
+    if channels_last:
+        G.synthesis.to(memory_format=torch.channels_last)
+    return G
+
+#----------------------------------------------------------------------------
+
+def load_generator(network_pkl: str, device: torch.device, channels_last: bool = False) -> torch.nn.Module:
+    '''Load G_ema from a network pickle onto device.'''
+
+    import dnnlib # pylint: disable=import-outside-toplevel
+    import legacy # pylint: disable=import-outside-toplevel
+
+    with dnnlib.util.open_url(network_pkl) as f:
+        G = legacy.load_network_pkl(f)['G_ema'].to(device) # type: ignore
+    return prepare_generator(G, channels_last)
+
+#----------------------------------------------------------------------------
+
+def w_cache_option(fn):
+    '''Add the --w-cache option to a click command.'''
+
+    return click.option('--w-cache', 'w_cache_dir', help='Directory that caches the W vectors of seeds across runs', metavar='DIR')(fn)
+
+#----------------------------------------------------------------------------
+
+def network_hash(network_pkl: str, chunk_size: int = 1 << 20) -> str:
+    '''Return the sha1 of a network pickle file, or of its URL if it is not a local file.'''
+
+    sha1 = hashlib.sha1()
+    if not os.path.isfile(network_pkl):
+        sha1.update(network_pkl.encode('utf8'))
+        return sha1.hexdigest()
+    with open(network_pkl, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+#----------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def lock_file(lock_fname: str, stale_seconds: float = 600):
+    '''Hold the lock file lock_fname, created exclusively, for the body of a with statement.
+    A lock older than stale_seconds is taken to be left behind by a killed run and removed.'''
+
+    while True:
+        try:
+            fd = os.open(lock_fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_fname) > stale_seconds:
+                    os.remove(lock_fname)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+    try:
+        os.write(fd, f'{socket.gethostname()} {os.getpid()}'.encode('utf8'))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_fname)
+
+#----------------------------------------------------------------------------
+
+class WCache:
+    '''Mapped and truncated W vectors kept on disk across runs, keyed by (network pickle hash, seed, truncation psi).
+
+    The vectors of one network and psi are rows of a float32 .npy array that is
+    memory-mapped, the seed of every row is listed in a JSON file next to it.
+    Runs that share a cache directory, e.g. the processes of a --chunks render,
+    add rows one at a time under a lock file and keep the rows of each other.'''
+
+    def __init__(self, cache_dir: str, network_pkl: str, truncation_psi: float):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f'{network_hash(network_pkl)[:16]}_psi_{truncation_psi!r}')
+        self.rows: Dict[int, int] = {}
+        self.ws = None
+        self._load()
+
+    def _load(self):
+        # The rows listed in the JSON file are always in the .npy file, which is written first.
+        if os.path.isfile(self.path + '_seeds.json') and os.path.isfile(self.path + '.npy'):
+            with open(self.path + '_seeds.json', 'r') as file:
+                self.rows = { seed: row for row, seed in enumerate(json.load(file)) }
+            self.ws = np.load(self.path + '.npy', mmap_mode='r+')
+
+    def lookup(self, seeds: List[int]) -> Dict[int, np.ndarray]:
+        '''Return { seed: [num_ws, w_dim] array } for the cached seeds.'''
+
+        return { seed: self.ws[self.rows[seed]] for seed in seeds if seed in self.rows }
+
+    def add(self, seeds: List[int], ws: np.ndarray):
+        '''Store the [len(seeds), num_ws, w_dim] W vectors of new seeds.'''
+
+        tmp_tag = f'{socket.gethostname()}.{os.getpid()}.tmp'
+        with lock_file(self.path + '.lock'):
+            # Another run may have added rows since the cache was loaded.
+            self._load()
+            new_rows = [i for i, seed in enumerate(seeds) if seed not in self.rows]
+            seeds = [seeds[i] for i in new_rows]
+            ws = ws[new_rows]
+            if not seeds:
+                return
+
+            count = len(self.rows)
+            if self.ws is None or count + len(seeds) > len(self.ws):
+                # Grow the array into a new file, doubling its capacity.
+                capacity = max(2 * count, count + len(seeds), 1024)
+                grown = np.lib.format.open_memmap(f'{self.path}.{tmp_tag}.npy', mode='w+', dtype=np.float32, shape=(capacity, *ws.shape[1:]))
+                if self.ws is not None:
+                    grown[:count] = self.ws[:count]
+                grown.flush()
+                del grown
+                self.ws = None
+                os.replace(f'{self.path}.{tmp_tag}.npy', self.path + '.npy')
+                self.ws = np.load(self.path + '.npy', mmap_mode='r+')
+
+            self.ws[count:count + len(seeds)] = ws
+            self.ws.flush()
+            self.rows.update((seed, count + i) for i, seed in enumerate(seeds))
+            with open(f'{self.path}_seeds.json.{tmp_tag}', 'w') as file:
+                json.dump(sorted(self.rows, key=self.rows.get), file)
+            os.replace(f'{self.path}_seeds.json.{tmp_tag}', self.path + '_seeds.json')
+
+#----------------------------------------------------------------------------
+
+def map_seeds(G: torch.nn.Module, seeds: List[int], truncation_psi: float, device: torch.device, w_cache: Optional[WCache] = None) -> torch.Tensor:
+    '''Return the truncated W vectors of seeds as a [len(seeds), num_ws, w_dim] tensor.
+    Only the seeds that are not in w_cache go through the mapping network.'''
+
+    cached = w_cache.lookup(seeds) if w_cache is not None else {}
+    missing = [seed for seed in dict.fromkeys(seeds) if seed not in cached]
+    if w_cache is not None:
+        print(f'W cache: {len(seeds) - len(missing)} of {len(seeds)} seeds cached')
+
+    if missing:
+        all_z = np.stack([np.random.RandomState(seed).randn(G.z_dim) for seed in missing])
+        with torch.inference_mode():
+            all_w = G.mapping(torch.from_numpy(all_z).to(device), None)
+            w_avg = G.mapping.w_avg
+            all_w = w_avg + (all_w - w_avg) * truncation_psi
+        if w_cache is None and len(missing) == len(seeds):
+            return all_w
+        all_w = all_w.cpu().numpy()
+        if w_cache is not None:
+            w_cache.add(missing, all_w)
+        cached.update(zip(missing, all_w))
+
+    return torch.from_numpy(np.stack([cached[seed] for seed in seeds])).to(device)
+
+#----------------------------------------------------------------------------
+
+def synthesize(G: torch.nn.Module, ws: torch.Tensor, noise_mode: str = 'const') -> torch.Tensor:
+    '''Synthesize a batch of W vectors into [N, H, W, 3] uint8 RGB images on the device of ws.'''
+
+    # The fp16 layers of StyleGAN2 ADA only run on CUDA.
+    kwargs = {} if ws.device.type == 'cuda' else dict(force_fp32=True)
+    with torch.inference_mode():
+        images = G.synthesis(ws, noise_mode=noise_mode, **kwargs)
+        return (images.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
+
+#----------------------------------------------------------------------------
+
+def synthesize_batches(G: torch.nn.Module, ws: torch.Tensor, batch_size: int, noise_mode: str = 'const') -> Iterator[torch.Tensor]:
+    '''Yield the synthesize() output for ws in mini-batches of at most batch_size W vectors.'''
+
+    for i in range(0, len(ws), batch_size):
+        yield synthesize(G, ws[i:i + batch_size], noise_mode)
+
+#----------------------------------------------------------------------------
+
+class StandInMapping(torch.nn.Module):
+    def __init__(self, z_dim: int, w_dim: int, num_ws: int):
+        super().__init__()
+        self.z_dim = z_dim
+        self.num_ws = num_ws
+        self.fc0 = torch.nn.Linear(z_dim, w_dim)
+        self.fc1 = torch.nn.Linear(w_dim, w_dim)
+        self.register_buffer('w_avg', torch.zeros([w_dim]))
+
+    def forward(self, z, c, truncation_psi=1):
+        x = torch.nn.functional.leaky_relu(self.fc0(z.to(torch.float32)), 0.2)
+        x = torch.nn.functional.leaky_relu(self.fc1(x), 0.2)
+        return x.unsqueeze(1).repeat([1, self.num_ws, 1])
+
+class StandInSynthesis(torch.nn.Module):
+    def __init__(self, w_dim: int, img_resolution: int, channels: int):
+        super().__init__()
+        self.num_layers = int(np.log2(img_resolution)) - 1
+        self.num_ws = self.num_layers + 1
+        self.const = torch.nn.Parameter(torch.randn([channels, 4, 4]))
+        self.affines = torch.nn.ModuleList([torch.nn.Linear(w_dim, channels) for _ in range(self.num_layers)])
+        self.convs = torch.nn.ModuleList([torch.nn.Conv2d(channels, channels, 3, padding=1) for _ in range(self.num_layers)])
+        self.torgb = torch.nn.Conv2d(channels, 3, 1)
+
+    def forward(self, ws, noise_mode='const', force_fp32=False):
+        x = self.const.unsqueeze(0).repeat([ws.shape[0], 1, 1, 1])
+        for i, (affine, conv) in enumerate(zip(self.affines, self.convs)):
+            if i != 0:
+                x = torch.nn.functional.interpolate(x, scale_factor=2, mode='nearest')
+            x = x * (affine(ws[:, i]) + 1).unsqueeze(2).unsqueeze(3)
+            x = torch.nn.functional.leaky_relu(conv(x), 0.2)
+        return torch.tanh(self.torgb(x))
+
+class StandInGenerator(torch.nn.Module):
+    '''A small randomly initialized network with the interface of a StyleGAN2 ADA G_ema,
+    to test and benchmark the style utilities without a network pickle or GPU.'''
+
+    def __init__(self, img_resolution: int = 256, z_dim: int = 512, w_dim: int = 512, channels: int = 64, seed: int = 0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.z_dim = z_dim
+        self.w_dim = w_dim
+        self.img_resolution = img_resolution
+        self.synthesis = StandInSynthesis(w_dim, img_resolution, channels)
+        self.num_ws = self.synthesis.num_ws
+        self.mapping = StandInMapping(z_dim, w_dim, self.num_ws)
+
+#----------------------------------------------------------------------------
@@ -13,17 +13,16 @@
 
 import os
 import re
-from typing import List
+import time
+from typing import List, Optional
 
 import click
-import dnnlib
-import numpy as np
-import PIL.Image
 import torch
 
 import cv2
 
-import legacy
+from style_generator import WCache, generator_options, load_generator, map_seeds, pick_device, set_num_threads, synthesize_batches, w_cache_option
+from style_writers import ThreadedWriter, VideoEncoder, save_png, video_codec_option
 
 #----------------------------------------------------------------------------
 
@@ -39,6 +38,22 @@ def num_range(s: str) -> List[int]:
 
 #----------------------------------------------------------------------------
 
+def interpolate_ws(keyframe_ws: torch.Tensor, step: int) -> torch.Tensor:
+    '''Return the W vectors of every frame of a sequence of keyframes in one tensor.
+
+    The [K, num_ws, w_dim] keyframes give (K - 1) * step + 1 frames: each keyframe
+    followed by step - 1 linear interpolations to the next one, then the last keyframe.'''
+
+    i = torch.arange(step, dtype=keyframe_ws.dtype, device=keyframe_ws.device).reshape(1, step, 1, 1)
+    w_from = keyframe_ws[:-1].unsqueeze(1)
+    w_to   = keyframe_ws[1:].unsqueeze(1)
+    frame_ws = (w_from * (step - i) + w_to * i) / step
+    # Keep the keyframes exact.
+    frame_ws[:, 0] = keyframe_ws[:-1]
+    return torch.cat([frame_ws.flatten(0, 1), keyframe_ws[-1:]])
+
+#----------------------------------------------------------------------------
+
 @click.command()
 @click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
 @click.option('--seeds', 'seeds', type = num_range, help = 'List of random seeds to interpolation', required = True)
@@ -48,6 +63,10 @@ def num_range(s: str) -> List[int]:
 @click.option('--trunc', 'truncation_psi', type=float, help='Truncation psi', default=1, show_default=True)
 @click.option('--noise-mode', help='Noise mode', type=click.Choice(['const', 'random', 'none']), default='const', show_default=True)
 @click.option('--outdir', type=str, required=True)
+@click.option('--batch-size', type = int, help = 'Number of frames per synthesis call, lower it if it runs out of memory', default = 16, show_default = True)
+@video_codec_option
+@w_cache_option
+@generator_options
 def generate_style_interpolation(
     network_pkl: str,
     seeds: List[int],
@@ -56,7 +75,14 @@ def generate_style_interpolation(
     export_image: bool, 
     truncation_psi: float,
     noise_mode: str,
-    outdir: str
+    outdir: str,
+    batch_size: int,
+    codec: str,
+    device: str,
+    threads: int,
+    interop_threads: int,
+    channels_last: bool,
+    w_cache_dir: Optional[str]
 ):
     """Generate style interpolation images using pretrained network pickle.
 
@@ -65,66 +91,68 @@ def generate_style_interpolation(
     \b
     python style_interpolation.py --seeds=164,218 \\
         --network=https://nvlabs-fi-cdn.nvidia.com/stylegan2-ada-pytorch/pretrained/metfaces.pkl
+
+    The generator runs on the GPU if there is one and on the CPU otherwise,
+    see --device.  On CPU-only nodes set --threads and try --channels-last,
+    style_benchmark.py synthesis compares both layouts.
     """
-    print('Loading networks from "%s"...' % network_pkl)
-    device = torch.device('cuda')
-    with dnnlib.util.open_url(network_pkl) as f:
-        G = legacy.load_network_pkl(f)['G_ema'].to(device) # type: ignore
+    device = pick_device(device)
+    set_num_threads(threads, interop_threads)
+    print('Loading networks from "%s" on %s...' % (network_pkl, device))
+    G = load_generator(network_pkl, device, channels_last)
 
     os.makedirs(outdir, exist_ok=True)
 
     print('Generating W vectors...')
     all_seeds = list(set(seeds))
-    all_z = np.stack([np.random.RandomState(seed).randn(G.z_dim) for seed in all_seeds])
-    all_w = G.mapping(torch.from_numpy(all_z).to(device), None)
-    w_avg = G.mapping.w_avg
-    all_w = w_avg + (all_w - w_avg) * truncation_psi
+    w_cache = WCache(w_cache_dir, network_pkl, truncation_psi) if w_cache_dir is not None else None
+    all_w = map_seeds(G, all_seeds, truncation_psi, device, w_cache)
     w_dict = {seed: w for seed, w in zip(all_seeds, list(all_w))}
 
     print('Generating style-interpolation images...')
 
-    from_seed = seeds.pop(0)
-    w     = w_dict[from_seed] 
-    image = G.synthesis(w[np.newaxis], noise_mode = noise_mode) 
-    image = (image.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-    result_list = [(from_seed, None, None, image[0].cpu().numpy())]
-    while seeds:
-        to_seed = seeds.pop(0)
-        print(f"Generate interpolation for image {from_seed}-{to_seed} ...")
-        for i in range(1, step):
-            w = (w_dict[from_seed] * (step - i) + w_dict[to_seed] * i) / step
-            image = G.synthesis(w[np.newaxis], noise_mode=noise_mode)
-            image = (image.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-            result_list.append((from_seed, to_seed, i, image[0].cpu().numpy()))
-        from_seed = to_seed 
-
-        w     = w_dict[from_seed] 
-        image = G.synthesis(w[np.newaxis], noise_mode = noise_mode) 
-        image = (image.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-        result_list.append((from_seed, None, None, image[0].cpu().numpy()))
+    # (from_seed, to_seed, step) of every frame, to_seed and step are None for the keyframes
+    frame_info = []
+    for from_seed, to_seed in zip(seeds[:-1], seeds[1:]):
+        frame_info.append((from_seed, None, None))
+        frame_info += [(from_seed, to_seed, i) for i in range(1, step)]
+    frame_info.append((seeds[-1], None, None))
 
-    print('Saving video...')
-    file_name = f"{outdir}/Interpolation Style Gan {step} step {FPS} FPS.avi"
     video_width  = G.img_resolution
     video_height = G.img_resolution
-    video = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'MJPG'), FPS, (video_width, video_height))
-    for _, _, _, image in result_list:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        video.write(image)
-    video.release()
-
-    if not export_image:
-        return
-
-    print('Saving images...')
-    os.makedirs(outdir, exist_ok = True)
-    for i, (from_seed, to_seed, current_step, image) in enumerate(result_list):
-        if current_step is None:
-            file_name = f"{outdir}/{str(i).zfill(5)} image {from_seed}.png"
-            PIL.Image.fromarray(image, 'RGB').save(file_name)
-        else:
-            file_name = f"{outdir}/{str(i).zfill(5)} interpolate {from_seed}-{to_seed} {i} of {step}.png"
-            PIL.Image.fromarray(image, 'RGB').save(file_name)
+    video = VideoEncoder(f"{outdir}/Interpolation Style Gan {step} step {FPS} FPS", codec, FPS, video_width, video_height, max_pending = batch_size)
+    png_writer = ThreadedWriter(save_png, max_pending = batch_size) if export_image else None
+
+    # Every batch goes to the video encoder thread, and to the PNG writer thread, as soon
+    # as it is synthesized, so only a few batches of frames are in memory at a time.
+    frame_ws = interpolate_ws(torch.stack([w_dict[seed] for seed in seeds]), step)
+    frame_count = 0
+    generate_seconds = 0.0
+    generate_start = time.perf_counter()
+    for images in synthesize_batches(G, frame_ws, batch_size, noise_mode):
+        images = images.cpu().numpy()
+        generate_seconds += time.perf_counter() - generate_start
+        print(f"Generate frame {frame_count + len(images)}/{len(frame_ws)} ...")
+        for image in images:
+            video.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+            if png_writer is not None:
+                from_seed, to_seed, current_step = frame_info[frame_count]
+                if current_step is None:
+                    file_name = f"{outdir}/{str(frame_count).zfill(5)} image {from_seed}.png"
+                else:
+                    file_name = f"{outdir}/{str(frame_count).zfill(5)} interpolate {from_seed}-{to_seed} {current_step} of {step}.png"
+                png_writer.put((file_name, image))
+            frame_count += 1
+        generate_start = time.perf_counter()
+
+    print('Saving video...')
+    video.close()
+    if png_writer is not None:
+        print('Saving images...')
+        png_writer.close()
+    print(f"Generation {generate_seconds / frame_count * 1000:.2f} ms per frame, {video.summary()}")
+
 #----------------------------------------------------------------------------
 
 if __name__ == "__main__":
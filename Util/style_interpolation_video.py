@@ -11,20 +11,22 @@
 
 """Generate style interpolation video using pretrained network pickle."""
 
+import json
 import os
 import re
-from typing import List
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
 
 import click
-import dnnlib
 import numpy as np
 import PIL.Image
 import torch
 
-import cv2
 import random
 
-import legacy
+from style_generator import WCache, generator_options, load_generator, map_seeds, pick_device, set_num_threads, synthesize_batches, w_cache_option
+from style_writers import VIDEO_CODECS, VideoEncoder, concat_videos, resolve_codec, video_codec_option
 
 #----------------------------------------------------------------------------
 
@@ -42,58 +44,71 @@ def num_range(s: str) -> List[int]:
 
 def create_seed_mapping(N_row: int, N_col: int, N_wanted_elem: int, elem_list: List[int], state: int) -> List[List[List[int]]]:
     '''Create a grid mapping of element sequence 
-    such that no two element in any two sequence have the same value and index'''
-
-    N_wanted_list = N_row * N_col
-
-    all_list      = []
-    pair_set      = set()
-    location_dict = {elem: [] for elem in elem_list}
-    for list_id in range(N_wanted_list):
-        row_id = int(list_id / N_col)
-        col_id =     list_id % N_col
+    such that no two element in any two sequence have the same value and index,
+    no element appears twice in a sequence and no two sequences have the same pair of consecutive elements.
+    Each element is placed as far as possible from its other placements in (row, col, index) space.
+    Return None if the elements run out.'''
+
+    elems   = np.array(list(dict.fromkeys(elem_list)))
+    N_elem  = len(elems)
+    rng     = np.random.RandomState(state)
+
+    used_at   = np.zeros((N_wanted_elem, N_elem), dtype = bool)  # element used at this index by a sequence
+    neighbors = [[] for _ in range(N_elem)]                      # elements that were consecutive to this element
+    positions = np.zeros((N_row * N_col * N_wanted_elem, 3))     # (row, col, index) of every placement
+    placed    = np.zeros(N_row * N_col * N_wanted_elem, dtype = np.int64)
+    N_placed  = 0
+
+    all_list = []
+    for list_id in range(N_row * N_col):
+        location = np.array([list_id // N_col, list_id % N_col, 0], dtype = float)
+        in_list  = np.zeros(N_elem, dtype = bool)
         new_list = []
         for elem_id in range(N_wanted_elem):
-            non_candidates = set(new_list + [lst[len(new_list)] for lst in all_list])
-            candidates = set(elem_list).difference(non_candidates)
-            candidates = list(candidates)
-
-            random.Random(state).shuffle(candidates)
-            candidates_distance_to_closet = []
-            for candidate in candidates:
-                min_distance = 10 ** 9
-                for r, c, e in location_dict[candidate]:
-                    distance     = ((row_id - r) ** 2 + (col_id - c) ** 2 + (elem_id - e) ** 2) ** 0.5
-                    min_distance = min(min_distance, distance)
-
-                candidates_distance_to_closet.append((candidate, min_distance))
-
-            candidate_with_farthest_distance = None
-            farthest_distance                = 0
-
-            for candidate, distance in candidates_distance_to_closet:
-                previous_elem = new_list[-1] if new_list else -1
-                if not ((previous_elem, candidate) in pair_set):   
-                    if distance > farthest_distance:                     
-                        candidate_with_farthest_distance = candidate
-                        farthest_distance                = distance
-                    if farthest_distance == 10 ** 9:
-                        break
-
+            location[2] = elem_id
+            valid = ~in_list & ~used_at[elem_id]
             if new_list:
-                if candidate_with_farthest_distance:
-                    pair_set.add((new_list[-1], candidate_with_farthest_distance))
-                    pair_set.add((candidate_with_farthest_distance, new_list[-1]))
-                else: 
-                    return None
+                valid[neighbors[new_list[-1]]] = False
 
-            new_list.append(candidate_with_farthest_distance)
-            location_dict[candidate_with_farthest_distance].append((row_id, col_id, elem_id))
+            # Squared distance to the closest placement of every element, inf if it was never placed
+            distance = np.full(N_elem, np.inf)
+            np.minimum.at(distance, placed[:N_placed], ((positions[:N_placed] - location) ** 2).sum(axis = 1))
+            distance[~valid] = -1
+
+            # Farthest valid element, ties broken in a random order
+            order = rng.permutation(N_elem)
+            best  = order[np.argmax(distance[order])]
+            if distance[best] < 0:
+                return None
+
+            if new_list:
+                neighbors[new_list[-1]].append(best)
+                neighbors[best].append(new_list[-1])
+            in_list[best] = True
+            used_at[elem_id, best] = True
+            positions[N_placed] = location
+            placed[N_placed]    = best
+            N_placed += 1
+            new_list.append(best)
 
-        all_list.append(new_list)
+        all_list.append([int(elems[elem]) for elem in new_list])
 
     mapping = [[all_list[i * N_col + j] for j in range(N_col)] for i in range(N_row)]
     return mapping
+
+#----------------------------------------------------------------------------
+
+def count_seed_mapping_collisions(mapping: List[List[List[int]]]) -> int:
+    '''Return the number of placements that break the guarantees of create_seed_mapping.'''
+
+    sequences  = [sequence for row in mapping for sequence in row]
+    collisions = sum(len(sequence) - len(set(sequence)) for sequence in sequences)
+    for index in range(len(sequences[0]) if sequences else 0):
+        column = [sequence[index] for sequence in sequences]
+        collisions += len(column) - len(set(column))
+    pairs = [frozenset(pair) for sequence in sequences for pair in zip(sequence[:-1], sequence[1:])]
+    collisions += len(pairs) - len(set(pairs))
+    return collisions
   
 #----------------------------------------------------------------------------  
 
@@ -118,6 +133,78 @@ def create_unique_seed_mapping(N_row: int, N_col: int, N_wanted_elem: int, elem_
 
 #----------------------------------------------------------------------------
 
+def tile_grid(images: torch.Tensor, num_row: int, num_col: int) -> torch.Tensor:
+    '''Tile [num_row * num_col, H, W, 3] RGB images row by row into one [num_row * H, num_col * W, 3]
+    BGR frame on their device.'''
+
+    _, height, width, channels = images.shape
+    grid = images.flip(3).reshape(num_row, num_col, height, width, channels)
+    return grid.permute(0, 2, 1, 3, 4).reshape(num_row * height, num_col * width, channels)
+
+#----------------------------------------------------------------------------
+
+def render_cells(G, w_dict: Dict[int, torch.Tensor], keys: List[Tuple[int, int, int]], step: int, batch_size: int, noise_mode: str) -> torch.Tensor:
+    '''Return the [len(keys), H, W, 3] uint8 images of the cells of one frame, synthesized
+    in mini-batches.  Key (seed_a, seed_b, i) is step i of the interpolation from
+    seed_a to seed_b, i = 0 being seed_a and i = step being seed_b.'''
+
+    ws = []
+    for seed_a, seed_b, i in keys:
+        if i == 0:
+            ws.append(w_dict[seed_a])
+        elif i == step:
+            ws.append(w_dict[seed_b])
+        else:
+            ws.append((w_dict[seed_a] * (step - i) + w_dict[seed_b] * i) / step)
+    return torch.cat(list(synthesize_batches(G, torch.stack(ws), batch_size, noise_mode)))
+
+#----------------------------------------------------------------------------
+
+def split_chunks(total_frame: int, chunk_frames: int) -> List[Tuple[int, int]]:
+    '''Return the [start, end) frame ranges of chunks of chunk_frames frames, 0 is a single chunk.'''
+
+    if chunk_frames <= 0:
+        return [(0, total_frame)]
+    return [(start, min(start + chunk_frames, total_frame)) for start in range(0, total_frame, chunk_frames)]
+
+#----------------------------------------------------------------------------
+
+def write_json(data, file_name: str):
+    '''Write data to file_name through a temporary file private to this process and host.'''
+
+    tmp_name = f'{file_name}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_name, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_name, file_name)
+
+#----------------------------------------------------------------------------
+
+def remove_stale_partials(chunk_dir: str, chunk_files: List[str]) -> int:
+    '''Remove the partial chunk files of chunks that are complete and of processes of this host
+    that are no longer running.  Return the number of removed files.'''
+
+    complete = {os.path.splitext(os.path.basename(chunk_file))[0] for chunk_file in chunk_files if os.path.isfile(chunk_file)}
+    host = socket.gethostname()
+    removed = 0
+    for name in os.listdir(chunk_dir):
+        m = re.match(r'^(chunk_\d+_\d+)\.(.+)\.(\d+)\.partial\.', name)
+        if not m:
+            continue
+        stale = m.group(1) in complete
+        if not stale and m.group(2) == host:
+            try:
+                os.kill(int(m.group(3)), 0)
+            except ProcessLookupError:
+                stale = True
+            except PermissionError:
+                pass
+        if stale:
+            os.remove(os.path.join(chunk_dir, name))
+            removed += 1
+    return removed
+
+#----------------------------------------------------------------------------
+
 @click.command()
 @click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
 @click.option('--seeds', 'seeds', type = num_range, help = 'List of random seeds to interpolation', required = True)
@@ -130,6 +217,12 @@ def create_unique_seed_mapping(N_row: int, N_col: int, N_wanted_elem: int, elem_
 @click.option('--noise-mode', help='Noise mode', type=click.Choice(['const', 'random', 'none']), default='const', show_default=True)
 @click.option('--outdir', type=str, required=True)
 @click.option("--state", "state", type = int, help = "random state", default = 1, show_default = True)
+@click.option('--batch-size', type = int, help = 'Number of cells per synthesis call, lower it if it runs out of memory', default = 32, show_default = True)
+@click.option('--chunk-frames', type = int, help = 'Render the video in resumable chunks of this many frames, 0 renders a single file', default = 0, show_default = True)
+@click.option('--chunks', 'chunk_ids', type = num_range, help = 'Only render these chunks, to split a chunked render across processes that share --outdir')
+@video_codec_option
+@w_cache_option
+@generator_options
 def generate_style_interpolation_video(
     network_pkl: str,
     seeds: List[int],
@@ -141,25 +234,43 @@ def generate_style_interpolation_video(
     truncation_psi: float,
     noise_mode: str,
     outdir: str,
-    state: int
+    state: int,
+    batch_size: int,
+    chunk_frames: int,
+    chunk_ids: Optional[List[int]],
+    codec: str,
+    device: str,
+    threads: int,
+    interop_threads: int,
+    channels_last: bool,
+    w_cache_dir: Optional[str]
 ):
-    """Generate style interpolation video using pretrained network pickle."""
+    """Generate style interpolation video using pretrained network pickle.
+
+    The generator runs on the GPU if there is one and on the CPU otherwise, see --device.
+
+    The video starts on the first image of every cell and shows step frames per
+    following image, the last of which is the image itself.
 
-    print('Loading networks from "%s"...' % network_pkl)
-    device = torch.device('cuda')
-    with dnnlib.util.open_url(network_pkl) as f:
-        G = legacy.load_network_pkl(f)['G_ema'].to(device) # type: ignore
+    With --chunk-frames, every chunk is written to its own file in a chunks
+    directory next to the video, together with a manifest.json of the render
+    settings, the seed mapping and the completed frame ranges.  Running the same
+    command again skips the completed chunks, so a crashed render resumes from
+    the last complete chunk.  It also removes the partial files of complete
+    chunks and of interrupted processes of this host.  Processes that share
+    --outdir can render disjoint --chunks in parallel, for example:
+
+    \b
+    python style_interpolation_video.py ... --chunk-frames 900 --chunks 0-9
+    python style_interpolation_video.py ... --chunk-frames 900 --chunks 10-19
+
+    Once every chunk is complete, the chunks are joined into the video by ffmpeg
+    without re-encoding.
+    """
 
     os.makedirs(outdir, exist_ok=True)
 
-    print('Generating W vectors ...')
     seeds = list(set(seeds))
-    all_z = np.stack([np.random.RandomState(seed).randn(G.z_dim) for seed in seeds])
-    all_w = G.mapping(torch.from_numpy(all_z).to(device), None)
-    w_avg = G.mapping.w_avg
-    all_w = w_avg + (all_w - w_avg) * truncation_psi
-    w_dict = {seed: w for seed, w in zip(seeds, list(all_w))}
-
     seed_mapping = create_unique_seed_mapping(num_row, num_col, image_per_cell, seeds, state)
     if seed_mapping is None:
         seed_mapping = create_seed_mapping(num_row, num_col, image_per_cell, seeds, state)
@@ -168,100 +279,132 @@ def generate_style_interpolation_video(
         print("Cannot create seed mapping, please retry or increase the number of seeds")
         return 
 
-    cell_width  = G.img_resolution
-    cell_height = G.img_resolution
-    video_width  = cell_width  * num_col
-    video_height = cell_height * num_row
-
-    file_name = f"{outdir}/Interpolation Style GAN {num_row} by {num_col}, {step} step, {FPS} FPS, {image_per_cell} image per cell, state {state}.avi"
-    video = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'MJPG'), FPS, (video_width, video_height))
-
-    total_frame = step * (image_per_cell - 1) + 1
-    frame_count = 0
-
-    pair_seed_mapping = [None, None]
-    for k in range(image_per_cell):
-        seed_mapping_k    = [[seed_mapping[i][j][k] for j in range(num_col)] for i in range(num_row)]
-        pair_seed_mapping = [pair_seed_mapping[1], seed_mapping_k]
-        frame = np.zeros((video_height, video_width, 3), np.uint8)
-
-        if pair_seed_mapping[0] == None:
-            w_list = []
-            for i in range(num_row):
-                for j in range(num_col):
-                    w_list.append(w_dict[seed_mapping_k[i][j]])
-            
-            from_id = 0
-            to_id   = 32
-            images  = None
-            while from_id < len(w_list):
-                w_sub_list = torch.stack(w_list[from_id:min(to_id, len(w_list))])
-                sub_images = G.synthesis(w_sub_list, noise_mode = noise_mode) 
-                sub_images = (sub_images.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-                
-                if images is None:
-                    images = sub_images
-                else:
-                    images = torch.cat((images, sub_images), 0)
-
-                from_id += 32
-                to_id   += 32
-        
-            for i in range(num_row):
-                for j in range(num_col):
-                    image = images[i * num_col + j].cpu().numpy()
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                    
-                    x_cell = cell_width  * i
-                    y_cell = cell_height * j
-                    frame[x_cell:x_cell + cell_width:, y_cell:y_cell + cell_height:, ::] = image
-            
-            frame_count += 1
-            print(f"Generating style-interpolation frame {frame_count}/{total_frame} ...")
-            video.write(frame)
-            continue
-
-        for i in range(step):
-            w_list = []
+    # Frame i of segment k blends the seeds k - 1 and k of every cell, i = step being keyframe k.
+    # The first segment only holds keyframe 0.
+    frames = [(k, i) for k in range(image_per_cell) for i in ([0] if k == 0 else range(1, step + 1))]
+    total_frame = len(frames)
+
+    file_base = f"{outdir}/Interpolation Style GAN {num_row} by {num_col}, {step} step, {FPS} FPS, {image_per_cell} image per cell, state {state}"
+    codec     = resolve_codec(codec)
+    extension = VIDEO_CODECS[codec][0]
+    chunks    = split_chunks(total_frame, chunk_frames)
+
+    if chunk_frames > 0:
+        # A chunk is complete once its file exists, it is renamed into place after the encoder is closed.
+        chunk_dir     = f"{file_base} chunks"
+        manifest_file = f"{chunk_dir}/manifest.json"
+        chunk_files   = [f"{chunk_dir}/chunk_{start:06d}_{end - 1:06d}{extension}" for start, end in chunks]
+        settings      = dict(network_pkl = network_pkl, seeds = sorted(seeds), step = step, FPS = FPS, num_row = num_row, num_col = num_col,
+                             image_per_cell = image_per_cell, truncation_psi = truncation_psi, noise_mode = noise_mode, state = state,
+                             codec = codec, chunk_frames = chunk_frames)
+        os.makedirs(chunk_dir, exist_ok=True)
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as file:
+                manifest = json.load(file)
+            if manifest['settings'] != settings:
+                changed = [key for key in settings if manifest['settings'].get(key) != settings[key]]
+                print(f"{manifest_file} was written with different {', '.join(changed)}, render into another --outdir")
+                return
+            # Every process renders the cells of the mapping of the first one.
+            seed_mapping = manifest['seed_mapping']
+        manifest = dict(settings = settings, seed_mapping = seed_mapping, chunks = chunks, completed = [])
+
+        def update_manifest():
+            manifest['completed'] = [chunk for chunk, chunk_file in zip(chunks, chunk_files) if os.path.isfile(chunk_file)]
+            write_json(manifest, manifest_file)
+
+        update_manifest()
+        print(f"{len(manifest['completed'])} of {len(chunks)} chunks of {chunk_frames} frames complete in \"{chunk_dir}\"")
+        num_removed = remove_stale_partials(chunk_dir, chunk_files)
+        if num_removed != 0:
+            print(f"Removed {num_removed} partial chunk files of interrupted renders")
+    else:
+        chunk_files = [file_base + extension]
+
+    pending = [chunk_id for chunk_id in (chunk_ids if chunk_frames > 0 and chunk_ids is not None else range(len(chunks)))
+               if 0 <= chunk_id < len(chunks) and not (chunk_frames > 0 and os.path.isfile(chunk_files[chunk_id]))]
+
+    if pending:
+        device = pick_device(device)
+        set_num_threads(threads, interop_threads)
+        print('Loading networks from "%s" on %s...' % (network_pkl, device))
+        G = load_generator(network_pkl, device, channels_last)
+
+        print('Generating W vectors ...')
+        w_cache = WCache(w_cache_dir, network_pkl, truncation_psi) if w_cache_dir is not None else None
+        all_w = map_seeds(G, seeds, truncation_psi, device, w_cache)
+        w_dict = {seed: w for seed, w in zip(seeds, list(all_w))}
+
+        cell_width  = G.img_resolution
+        cell_height = G.img_resolution
+        video_width  = cell_width  * num_col
+        video_height = cell_height * num_row
+
+        frame_count = 0
+
+        # Every frame is copied from the device into one of these buffers, pinned so that the copy is a
+        # single DMA.  A buffer is reused once the encoder thread is done with it.
+        max_pending      = 8
+        host_frames      = [torch.empty((video_height, video_width, 3), dtype = torch.uint8, pin_memory = device.type == 'cuda')
+                            for _ in range(max_pending + 2)]
+        grid_seconds     = 0.0
+        generate_seconds = 0.0
+        encode_seconds   = 0.0
+        render_frames    = sum(chunks[chunk_id][1] - chunks[chunk_id][0] for chunk_id in pending)
+
+    for chunk_id in pending:
+        chunk_start, chunk_end = chunks[chunk_id]
+        # Chunks are encoded under a name private to this process, so an interrupted chunk is never taken as complete.
+        chunk_base = os.path.splitext(chunk_files[chunk_id])[0]
+        if chunk_frames > 0:
+            chunk_base += f".{socket.gethostname()}.{os.getpid()}.partial"
+        video = VideoEncoder(chunk_base, codec, FPS, video_width, video_height, max_pending)
+
+        for k, i in frames[chunk_start:chunk_end]:
+            generate_start = time.perf_counter()
+            keys = []
             for row in range(num_row):
                 for col in range(num_col):
-                    w_src = w_dict[pair_seed_mapping[0][row][col]]
-                    w_dst = w_dict[pair_seed_mapping[1][row][col]]
-                    w_list.append((w_src * (step - i) + w_dst * i) / step)
-
-            from_id = 0
-            to_id   = 32
-            images  = None
-            while from_id < len(w_list):
-                w_sub_list = torch.stack(w_list[from_id:min(to_id, len(w_list))])
-                sub_images = G.synthesis(w_sub_list, noise_mode = noise_mode) 
-                sub_images = (sub_images.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8)
-                
-                if images is None:
-                    images = sub_images
-                else:
-                    images = torch.cat((images, sub_images), 0)
-
-                from_id += 32
-                to_id   += 32
+                    keys.append((seed_mapping[row][col][max(k - 1, 0)], seed_mapping[row][col][k], i))
+            images = render_cells(G, w_dict, keys, step, batch_size, noise_mode)
+
+            grid_start = time.perf_counter()
+            host_frame = host_frames[frame_count % len(host_frames)]
+            host_frame.copy_(tile_grid(images, num_row, num_col), non_blocking = True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            grid_seconds     += time.perf_counter() - grid_start
+            generate_seconds += time.perf_counter() - generate_start
 
-            for row in range(num_row):
-                for col in range(num_col):
-                    image = images[row * num_col + col].cpu().numpy()
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                    
-                    x_cell = cell_width  * row
-                    y_cell = cell_height * col
-                    frame[x_cell:x_cell + cell_width:, y_cell:y_cell + cell_height:, ::] = image
-                        
             frame_count += 1
-            print(f"\rGenerating style-interpolation frame {frame_count}/{total_frame} ...", end = '')
-            video.write(frame)
+            print(f"\rGenerating style-interpolation frame {frame_count}/{render_frames} ...", end = '')
+            video.write(host_frame.numpy())
 
         print()
-
-    print("Releasing video ...")
-    video.release()
+        print("Releasing video ...")
+        video.close()
+        encode_seconds += video.encode_seconds
+        if chunk_frames > 0:
+            os.replace(video.file_name, chunk_files[chunk_id])
+            update_manifest()
+            print(f"Chunk {chunk_id} of frames {chunk_start}-{chunk_end - 1} complete")
+
+    if pending:
+        print(f"Generation {generate_seconds / frame_count * 1000:.2f} ms per frame, including grid assembly {grid_seconds / frame_count * 1000:.2f} ms, "
+              f"{codec} encoding {encode_seconds / frame_count * 1000:.2f} ms per frame")
+
+    if chunk_frames > 0:
+        missing = len(chunks) - len(manifest['completed'])
+        if missing > 0:
+            print(f"{missing} chunks left to render, run again to resume")
+            return
+
+        # Every chunk is complete now, so no partial file belongs to a running render any more.
+        remove_stale_partials(chunk_dir, chunk_files)
+        if concat_videos(chunk_files, file_base + extension, f"{chunk_dir}/concat.txt"):
+            print(f"Joined {len(chunks)} chunks into \"{file_base + extension}\"")
+        else:
+            print(f"ffmpeg not found, join the chunks with: ffmpeg -f concat -safe 0 -i \"{chunk_dir}/concat.txt\" -c copy \"{file_base + extension}\"")
 
 #----------------------------------------------------------------------------
 
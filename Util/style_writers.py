@@ -0,0 +1,219 @@
+"""Background writers for the frames and images of the style utilities."""
+
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import zlib
+from typing import Any, Callable, List, Optional
+
+import click
+import cv2
+import numpy as np
+import PIL.Image
+
+#----------------------------------------------------------------------------
+
+class ThreadedWriter:
+    '''Run write(item) for every put() item in order on a dedicated thread.
+
+    The queue holds at most max_pending items, so put() blocks when the writer
+    falls behind and memory stays bounded.  An error of write() is raised again
+    by the next put() or by close().'''
+
+    def __init__(self, write: Callable[[Any], None], max_pending: int = 16):
+        self.write = write
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.write(item)
+                except BaseException as e: # pylint: disable=broad-except
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item: Any):
+        self._check()
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+#----------------------------------------------------------------------------
+
+def save_png(item):
+    '''Save an (file_name, HWC uint8 RGB array) item, for use with ThreadedWriter.'''
+
+    file_name, image = item
+    PIL.Image.fromarray(image, 'RGB').save(file_name)
+
+#----------------------------------------------------------------------------
+
+# File extension and cv2 fourcc of every codec, h264 is encoded by ffmpeg.
+VIDEO_CODECS = {
+    'mjpg': ('.avi', 'MJPG'),
+    'mp4v': ('.mp4', 'mp4v'),
+    'h264': ('.mp4', None),
+}
+
+#----------------------------------------------------------------------------
+
+def video_codec_option(fn):
+    '''Add the --codec option to a click command.'''
+
+    return click.option('--codec', help='Video codec, h264 needs ffmpeg on the PATH', type=click.Choice(list(VIDEO_CODECS)), default='mjpg', show_default=True)(fn)
+
+#----------------------------------------------------------------------------
+
+def resolve_codec(codec: str) -> str:
+    '''Return the codec VideoEncoder will actually use, mjpg instead of h264 if ffmpeg is not found.'''
+
+    if codec == 'h264' and shutil.which('ffmpeg') is None:
+        print('Warning: ffmpeg not found, encoding mjpg instead of h264')
+        return 'mjpg'
+    return codec
+
+#----------------------------------------------------------------------------
+
+class VideoEncoder:
+    '''Encode BGR frames into file_base + the extension of codec on a writer thread.
+
+    write() only queues the frame, so the caller must not modify it until at least
+    max_pending + 1 more frames were written.  h264 pipes raw frames to an ffmpeg
+    process and falls back to mjpg if ffmpeg is not found.'''
+
+    def __init__(self, file_base: str, codec: str, fps: int, width: int, height: int, max_pending: int = 8):
+        codec = resolve_codec(codec)
+        extension, fourcc = VIDEO_CODECS[codec]
+        self.codec          = codec
+        self.file_name      = file_base + extension
+        self.max_pending    = max_pending
+        self.encode_seconds = 0.0
+        self.frame_count    = 0
+
+        if fourcc is not None:
+            self.video = cv2.VideoWriter(self.file_name, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+            self.ffmpeg = None
+        else:
+            self.video = None
+            self.ffmpeg = subprocess.Popen([
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '18', self.file_name
+            ], stdin = subprocess.PIPE)
+        self.writer = ThreadedWriter(self._encode, max_pending)
+
+    def _encode(self, frame: np.ndarray):
+        start = time.perf_counter()
+        if self.video is not None:
+            self.video.write(frame)
+        else:
+            self.ffmpeg.stdin.write(np.ascontiguousarray(frame).data)
+        self.encode_seconds += time.perf_counter() - start
+        self.frame_count    += 1
+
+    def write(self, frame: np.ndarray):
+        self.writer.put(frame)
+
+    def close(self):
+        '''Wait for the queued frames and finish the file.'''
+
+        try:
+            self.writer.close()
+        finally:
+            if self.video is not None:
+                self.video.release()
+            else:
+                self.ffmpeg.stdin.close()
+                if self.ffmpeg.wait() != 0:
+                    raise RuntimeError(f'ffmpeg failed to encode {self.file_name}')
+
+    def summary(self) -> str:
+        return f'{self.codec} encoding {self.encode_seconds / max(self.frame_count, 1) * 1000:.2f} ms per frame'
+
+#----------------------------------------------------------------------------
+
+def concat_videos(file_names: List[str], output_file: str, list_file: str) -> bool:
+    '''Join videos of the same codec and size into output_file with the ffmpeg concat demuxer,
+    copying the packets without re-encoding.
+
+    The inputs are listed in list_file.  Return False and leave output_file alone if
+    ffmpeg is not found.'''
+
+    # The list and the joined video go through temporary files private to this process
+    # and host, other processes may be joining the same chunks at the same time.
+    tmp_tag = f'{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(f'{list_file}.{tmp_tag}', 'w') as file:
+        for file_name in file_names:
+            path = os.path.abspath(file_name).replace("'", "'\\''")
+            file.write(f"file '{path}'\n")
+    os.replace(f'{list_file}.{tmp_tag}', list_file)
+    if shutil.which('ffmpeg') is None:
+        return False
+
+    # Keep the extension, ffmpeg picks the container by it.
+    root, extension = os.path.splitext(output_file)
+    tmp_file = f'{root}.{tmp_tag}{extension}'
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', tmp_file
+    ], check = True)
+    os.replace(tmp_file, output_file)
+    return True
+
+#----------------------------------------------------------------------------
+
+class PngStreamWriter:
+    '''Write an 8-bit RGB PNG strip by strip, so that the whole image never has to be in memory.'''
+
+    def __init__(self, file_name: str, width: int, height: int, compress_level: int = 6):
+        self.file = open(file_name, 'wb')
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, 2, 0, 0, 0]))
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self.file.write(len(data).to_bytes(4, 'big') + chunk_type)
+        self.file.write(data)
+        self.file.write(zlib.crc32(data, zlib.crc32(chunk_type)).to_bytes(4, 'big'))
+
+    def write_rows(self, rows: np.ndarray):
+        '''Append a [N, width, 3] uint8 strip below the rows written so far.'''
+
+        assert rows.shape[1:] == (self.width, 3) and self.rows_written + len(rows) <= self.height
+        # Every row starts with filter type 0 (None).
+        scanlines = np.zeros((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        scanlines[:, 1:] = rows.reshape(len(rows), -1)
+        data = self.compressor.compress(scanlines)
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError(f'{self.rows_written} rows written for a PNG of height {self.height}')
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self.file.close()
+
+#----------------------------------------------------------------------------